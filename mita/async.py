@@ -6,11 +6,12 @@ import jenkins
 import json
 import os
 import logging
+import time
 import warnings
 from sqlalchemy.exc import InvalidRequestError
-from mita import util, models, connections, providers
+from mita import util, models, connections, providers, reconcile, metrics
 from mita.exceptions import CloudNodeNotFound
-from celery.signals import worker_init
+from celery.signals import worker_init, task_prerun, task_postrun, task_failure
 
 from pecan.configuration import Config
 
@@ -61,6 +62,34 @@ def bootstrap_pecan(signal, sender, **kw):
     models.init_model()
 
 
+# when the tasks running in this worker started, by task ID
+_task_starts = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kw):
+    _task_starts[task_id] = time.time()
+
+
+@task_postrun.connect
+def record_task_runtime(task_id=None, task=None, **kw):
+    started = _task_starts.pop(task_id, None)
+    if started is not None:
+        metrics.histogram(
+            'celery_task_seconds', metrics.LATENCY_BUCKETS, task=task.name
+        ).observe(time.time() - started)
+    # workers are separate processes, save the metrics for the API to expose
+    try:
+        metrics.save()
+    except Exception:
+        logger.exception('unable to save metrics')
+
+
+@task_failure.connect
+def count_task_failure(sender=None, **kw):
+    metrics.counter('celery_task_failures', task=sender.name).inc()
+
+
 app = Celery('mita.async', broker='pyamqp://guest@localhost//', include=['mita.tasks'])
 
 
@@ -78,32 +107,57 @@ def check_idling():
 
     Once the
     """
-    jenkins_url = pecan.conf.jenkins['url']
-    jenkins_user = pecan.conf.jenkins['user']
-    jenkins_token = pecan.conf.jenkins['token']
-    conn = jenkins.Jenkins(jenkins_url, jenkins_user, jenkins_token)
-    ci_nodes = conn.get_nodes()
+    # the idle state of every node comes from the snapshot of the Jenkins
+    # agents shared with the other tasks, a single request at most
+    ci_nodes = util.get_jenkins_agents().values()
 
     # determine which nodes are nodes we have added, so that they can be processed:
-    mita_nodes = [n for n in ci_nodes if len(n['name'].split('__')) > 1]
-
-    if mita_nodes:
-        logger.info('found Jenkins nodes added by this service: %s' % len(mita_nodes))
-        # check if they are idle, and if so, ping the mita API so that it can handle
-        # proper removal of the node if it needs to
-        for n in mita_nodes:
-            node_info = conn.get_node_info(n['name'])
-            uuid = n['name'].split('__')[-1]
-            if node_info.get('idle'):
-                logging.info("found an idle node: %s" % n['name'])
-                node_endpoint = get_mita_api('nodes', uuid, 'idle')
-                requests.post(node_endpoint)
-            else:
-                logger.info('%s is not idle, reset node.idle_since' % n['name'])
-                node_endpoint = get_mita_api('nodes', uuid, 'active')
-                requests.post(node_endpoint)
-    else:
+    mita_nodes = dict(
+        (n['name'].split('__')[-1], n) for n in ci_nodes if len(n['name'].split('__')) > 1
+    )
+
+    if not mita_nodes:
         logger.info('no Jenkins nodes added by this service where found')
+        return
+
+    logger.info('found Jenkins nodes added by this service: %s' % len(mita_nodes))
+    # check if they are idle, and if so, record it so that they can be
+    # properly removed if they need to. All of them are loaded with a single
+    # query and updated in a single transaction, with a savepoint for each
+    # node so that one failing doesn't bring back the rows of the nodes that
+    # were already removed from Jenkins and the provider.
+    summary = {'idle': 0, 'active': 0, 'destroyed': 0, 'unchanged': 0, 'unknown': 0, 'failed': 0}
+    nodes = models.Node.query.filter(models.Node.identifier.in_(mita_nodes.keys())).all()
+    summary['unknown'] = len(mita_nodes) - len(nodes)
+    now = datetime.utcnow()
+    for node in nodes:
+        n = mita_nodes[node.identifier]
+        if n['idle']:
+            logger.info("found an idle node: %s" % n['name'])
+        savepoint = models.begin_nested()
+        try:
+            change = util.update_idle_state(
+                node, n['idle'], connections.jenkins_connection, now=now
+            )
+            savepoint.commit()
+        except Exception:
+            logger.exception('unable to update the idle state of node: %s', n['name'])
+            savepoint.rollback()
+            summary['failed'] += 1
+            continue
+        summary[change or 'unchanged'] += 1
+    try:
+        models.commit()
+    except Exception:
+        logger.exception('unable to update the idle state of nodes')
+        models.rollback()
+        raise
+    logger.info(
+        'idle check: %(idle)s became idle, %(active)s became active, '
+        '%(destroyed)s destroyed, %(unchanged)s unchanged, %(unknown)s unknown, '
+        '%(failed)s failed' % summary
+    )
+    return summary
 
 
 @app.task
@@ -160,10 +214,7 @@ def check_queue():
     Since the key 'wheezy' matches the node required by the build system to
     continue it goes off to create it.
     """
-    jenkins_url = pecan.conf.jenkins['url']
-    jenkins_user = pecan.conf.jenkins['user']
-    jenkins_token = pecan.conf.jenkins['token']
-    conn = jenkins.Jenkins(jenkins_url, jenkins_user, jenkins_token)
+    conn = connections.jenkins_connection()
     result = conn.get_queue_info()
     needed_nodes = {}
 
@@ -174,10 +225,13 @@ def check_queue():
                 # and there is no 'why' yet. So the API has a `None` for it which would break logic
                 # to infer what is needed to get it unstuck
                 continue
-            if util.is_stuck(task['why']):
+            # parse the reason only once, both to tell if it is stuck and to
+            # match a node for it
+            reason = util.classify_stuck(task['why'])
+            if reason:
                 logger.info('found stuck task with name: %s' % task['task']['name'])
                 logger.info('reason was: %s' % task['why'])
-                node_name = util.match_node(task['why'])
+                node_name = util.match_reason(reason)
                 if not node_name:
                     # this usually happens when jenkins is waiting on an executor
                     # on a static slave whose labels are not a subset of a
@@ -187,8 +241,10 @@ def check_queue():
                     job_url = task['task']['url']
                     job_name = util.job_from_url(job_url)
                     try:
-                        conn.get_job_info(job_name)
-                        logger.info("Job info found for: %s", job_name)
+                        # a job with a cached configuration is known to exist
+                        if not util.job_labels_are_cached(job_url):
+                            conn.get_job_info(job_name)
+                            logger.info("Job info found for: %s", job_name)
                         node_name = util.match_node_from_job_config(job_url)
                     except jenkins.JenkinsException:
                         logger.warning('No job info found for: %s', job_name)
@@ -232,6 +288,10 @@ def check_queue():
         logger.info('the Jenkins queue is empty, nothing to do')
     else:
         logger.warning('attempted to get queue info but got: %s' % result)
+    # how many stuck items are waiting on every type of node
+    for node_name in pecan.conf.nodes.keys():
+        metrics.gauge('stuck_queue_items', node=node_name).set(needed_nodes.get(node_name, 0))
+
     # At this point we might have a bag of nodes that we need to create, go over that
     # mapping and ask as many as Jenkins needs:
     node_endpoint = get_mita_api('nodes')
@@ -251,7 +311,6 @@ def check_orphaned():
     sure they exist in the provider and if so, remove them from the mita
     database and the provider.
     """
-    conn = connections.jenkins_connection()
     try:
         nodes = models.Node.query.all()
     except InvalidRequestError:
@@ -260,25 +319,46 @@ def check_orphaned():
         # we can try again at the next scheduled task run
         return
 
+    # one request for all the nodes in Jenkins, rather than one for each node.
+    # Nodes are destroyed when they are not in Jenkins, so make sure this
+    # doesn't use an older snapshot
+    util.get_jenkins_agents(refresh=True)
+
+    # the servers of every provider are listed once for this run, and that
+    # listing is shared by the destroy calls and the purge below
+    providers_conf = pecan.conf.provider.to_dict()
+    try:
+        for provider_name in providers_conf.keys():
+            providers.get(provider_name).refresh_inventory()
+    except Exception:
+        logger.exception('could not list the nodes in the providers')
+        return
+
     for node in nodes:
         # it is all good if this node exists in Jenkins. That is the whole
         # reason for its miserable existence, to work for Mr. Jenkins. Let it
-        # be.
-        if node.jenkins_name:
-            if conn.node_exists(node.jenkins_name):
-                continue
+        # be. Nodes that are not in the listing just fetched are not going to
+        # be in another one, so don't ask Jenkins again
+        if util.get_jenkins_name(node.identifier, refresh_on_miss=False):
+            continue
         # So this node is not in Jenkins. If it is less than 15 minutes then
         # don't do anything because it might be just taking a while to join.
         # ALERT MR ROBINSON: 15 minutes is a magical number.
-        now = datetime.utcnow()
-        difference = now - node.created
-        if difference.seconds > 900:  # magical number alert
+        if util.seconds_since(node.created) > util.ORPHAN_SECONDS:  # magical number alert
             logger.info("found created node that didn't join Jenkins: %s", node)
             provider = providers.get(node.provider)
             # "We often miss opportunity because it's dressed in overalls and
             # looks like work". Node missed his opportunity here.
             try:
-                provider.destroy_node(name=node.cloud_name)
+                # a node missing from the listing that was just fetched is
+                # gone, there is no need to list the servers again
+                provider.destroy_node(
+                    name=node.cloud_name,
+                    provider_id=node.provider_id,
+                    volume_id=node.volume_id,
+                    storage=node.storage,
+                    refresh_on_miss=False,
+                )
             except CloudNodeNotFound:
                 logger.info("cloud was not found on provider: %s", node.cloud_name)
                 logger.info("will remove node from database, API confirms it no longer exists")
@@ -290,12 +370,28 @@ def check_orphaned():
                 continue
 
     # providers can purge nodes in error state too, try to prune those as well
-    providers_conf =  pecan.conf.provider.to_dict()
     for provider_name in providers_conf.keys():
         provider = providers.get(provider_name)
         provider.purge()
 
 
+@app.task
+def reconcile_nodes():
+    """
+    Brings the database, the Jenkins agents, and the servers in the providers
+    in line in one pass, reading each of them once and removing the nodes that
+    need to go in batches. Besides what ``check_idling`` and
+    ``check_orphaned`` catch, it removes the rows of servers that are gone and
+    the servers that leaked. See ``mita.reconcile``.
+    """
+    try:
+        return reconcile.run()
+    except InvalidRequestError:
+        logger.exception('could not list nodes')
+        models.rollback()
+        # we can try again at the next scheduled task run
+
+
 def get_mita_api(endpoint=None, *args):
     """
     Puts together the API url for mita, so that we can talk to it. Optionally, the endpoint
@@ -330,6 +426,10 @@ app.conf.update(
             'task': 'async.check_idling',
             'schedule': timedelta(seconds=30),
         },
+        'reconcile-every-60-seconds': {
+            'task': 'async.reconcile_nodes',
+            'schedule': timedelta(seconds=60),
+        },
         'add-every-30-seconds': {
             'task': 'async.check_queue',
             'schedule': timedelta(seconds=30),
@@ -1,5 +1,7 @@
 import logging
-import subprocess
+import os
+import threading
+import time
 
 from celery.task.control import inspect
 from errno import errorcode
@@ -45,50 +47,157 @@ def rabbitmq_is_running():
 
 def database_connection():
     """
-    A very simple connection that should succeed if there is a good/correct
+    A very simple query that should succeed if there is a good/correct
     database connection.
     """
     try:
-        models.Node.query.all()
+        models.Session.execute('SELECT 1')
     except OperationalError as exc:
         raise SystemCheckError(
             "Could not connect or retrieve information from the database: %s" % exc.message)
 
 
-def disk_has_space(_popen=None):
+def disk_has_space(_statvfs=None):
     """
     If the disk where repos/binaries doesn't have enough space, fail the health
     check to prevent failing when the binaries are getting posted
     """
-    popen = _popen or subprocess.Popen
-    command = ['df', conf.get('repo_path', '/')]
-    result = popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    if result.returncode > 0:
-        raise SystemCheckError("failed disk check: %s" % result.stderr.read())
-    out = result.communicate()[0]
-    device, size, used, available, percent, mountpoint = out.split('\n')[1].split()
-    if int(percent.strip().split('%')[0]) > 85:
-        msg = 'disk %s almost full. Used: %s' % (device, percent)
+    statvfs = _statvfs or os.statvfs
+    path = conf.get('repo_path', '/')
+    try:
+        stat = statvfs(path)
+    except OSError as exc:
+        raise SystemCheckError("failed disk check: %s" % exc)
+    # like ``df``, blocks reserved for root don't count as available
+    used = stat.f_blocks - stat.f_bfree
+    usable = used + stat.f_bavail
+    if not usable:
+        return
+    # rounded up, like ``df`` does
+    percent = (used * 100 + usable - 1) // usable
+    if percent > 85:
+        msg = 'disk %s almost full. Used: %s%%' % (path, percent)
         raise SystemCheckError(msg)
 
 
+# ``rabbitmq_is_running`` already checks for Celery workers
 system_checks = (
     rabbitmq_is_running,
-    celery_has_workers,
     database_connection,
     disk_has_space,
 )
 
 
-def is_healthy():
+# the results of the last run of the checks, as a tuple of when they ran and
+# the result of every check by name
+_sample = (None, {})
+
+
+def run_checks():
     """
-    Perform all the registered system checks and detect if anything fails so
-    that the system can send a callback indicating an OK status
+    Perform all the registered system checks, recording for each one if it
+    passed, the error if it didn't, and how long it took. The results replace
+    the ones of the previous run.
     """
+    global _sample
+    results = {}
     for check in system_checks:
+        start = time.time()
+        error = None
         try:
             check()
-        except Exception:
+        except Exception as exc:
             logger.exception('system is unhealthy')
-            return False
-    return True
+            error = getattr(exc, 'message', None) or str(exc)
+        results[check.__name__] = {
+            'healthy': error is None,
+            'error': error,
+            'seconds': round(time.time() - start, 4),
+        }
+    _sample = (time.time(), results)
+    return results
+
+
+def health_conf():
+    """
+    How often (in seconds) the checks run in the background, and how old
+    their results can be before the system is considered unhealthy.
+    """
+    health = conf.get('health', {})
+    return health.get('interval', 30), health.get('max_age', 90)
+
+
+class Sampler(threading.Thread):
+    """
+    Runs the checks every ``interval`` seconds so that a health probe only
+    needs to read the results, instead of waiting on the checks to run.
+    """
+    daemon = True
+
+    def __init__(self, interval):
+        super(Sampler, self).__init__(name='health-sampler')
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                run_checks()
+            finally:
+                # the database session of this thread is not needed until the
+                # next run
+                models.clear()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+# the sampler of this process, a forked worker doesn't get the thread of its
+# parent so it needs to start its own
+_sampler = (None, None)
+_sampler_lock = threading.Lock()
+
+
+def start_sampler():
+    global _sampler
+    pid, sampler = _sampler
+    if pid == os.getpid() and sampler.is_alive():
+        return sampler
+    with _sampler_lock:
+        pid, sampler = _sampler
+        if pid != os.getpid() or not sampler.is_alive():
+            sampler = Sampler(health_conf()[0])
+            sampler.start()
+            _sampler = (os.getpid(), sampler)
+    return sampler
+
+
+def health_report():
+    """
+    The results of the last run of the checks, which runs in the background
+    (the sampler is started if it isn't running yet). Until there are results
+    the checks run right away, so a process that just started doesn't report
+    as unhealthy. The system is healthy when every check passed and the
+    results are not older than ``max_age`` seconds.
+    """
+    start_sampler()
+    if _sample[0] is None:
+        run_checks()
+    checked, results = _sample
+    interval, max_age = health_conf()
+    age = None if checked is None else round(time.time() - checked, 4)
+    fresh = age is not None and age <= max_age
+    return {
+        'healthy': fresh and all(r['healthy'] for r in results.values()),
+        'age': age,
+        'checks': results,
+    }
+
+
+def is_healthy():
+    """
+    Detect if anything failed in the last run of the registered system checks
+    so that the system can send a callback indicating an OK status
+    """
+    return health_report()['healthy']
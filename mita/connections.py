@@ -1,9 +1,135 @@
+import os
+import threading
+from urlparse import urlparse
+
 import jenkins
+import requests
+from requests.adapters import HTTPAdapter
 from pecan import conf
 
+from mita import metrics
+
+
+# parts of a Jenkins URL that are followed by the name of something, which are
+# grouped together when counting requests
+NAMED_SEGMENTS = ('job', 'computer', 'item', 'label')
+
+
+def jenkins_endpoint(url):
+    """
+    The endpoint of a Jenkins API URL, without the names of jobs, agents, or
+    queue items. For example::
+
+        http://jenkins.example.com/computer/centos7__2f3a/config.xml
+
+    is counted as ``/computer/*/config.xml``
+    """
+    parts = urlparse(url).path.strip('/').split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in NAMED_SEGMENTS and parts[i] != 'api':
+            parts[i] = '*'
+    return '/' + '/'.join(parts)
+
+
+def jenkins_request_counts():
+    """
+    The number of requests made to Jenkins by this process, by endpoint
+    """
+    return dict(
+        (histogram.labels['endpoint'], histogram.count)
+        for histogram in metrics.family('jenkins_request_seconds')
+    )
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    Keeps the connections to Jenkins alive in a pool (of ``pool_size``
+    connections) and counts (and times) every request that goes through it.
+    """
+
+    def send(self, request, **kw):
+        endpoint = jenkins_endpoint(request.url)
+        with metrics.timer('jenkins_request_seconds', endpoint=endpoint):
+            return super(CountingAdapter, self).send(request, **kw)
+
+
+def mount_adapter(session):
+    pool_size = conf.jenkins.get('pool_size', 10)
+    adapter = CountingAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def jenkins_timeout():
+    return conf.jenkins.get('timeout', 30)
+
+
+# shared clients by process (a forked worker can't use the connections of its
+# parent) and configuration
+_clients = {}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _client_key():
+    return (
+        os.getpid(),
+        conf.jenkins['url'],
+        conf.jenkins['user'],
+        conf.jenkins['token'],
+    )
+
 
 def jenkins_connection():
-    jenkins_url = conf.jenkins['url']
-    jenkins_user = conf.jenkins['user']
-    jenkins_token = conf.jenkins['token']
-    return jenkins.Jenkins(jenkins_url, jenkins_user, jenkins_token)
+    """
+    The ``jenkins.Jenkins`` client for this process. It is created once and
+    then reused, so that its connections are kept alive and the CSRF crumb
+    is only requested the first time it is needed.
+    """
+    key = _client_key()
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = jenkins.Jenkins(
+                    conf.jenkins['url'],
+                    conf.jenkins['user'],
+                    conf.jenkins['token'],
+                    jenkins_timeout(),
+                )
+                mount_adapter(client._session)
+                _clients[key] = client
+    return client
+
+
+class JenkinsSession(requests.Session):
+    """
+    A ``requests`` session that uses the configured timeout unless a request
+    sets its own.
+    """
+    timeout = None
+
+    def request(self, *a, **kw):
+        kw.setdefault('timeout', self.timeout)
+        return super(JenkinsSession, self).request(*a, **kw)
+
+
+def jenkins_session():
+    """
+    A ``requests`` session for the calls that go directly to the Jenkins API.
+    It is shared, so that connections are pooled and kept alive between
+    requests instead of opening a new one every time.
+    """
+    key = _client_key()
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = JenkinsSession()
+                session.auth = (conf.jenkins['user'], conf.jenkins['token'])
+                session.timeout = jenkins_timeout()
+                mount_adapter(session)
+                _sessions[key] = session
+    return session
@@ -1,11 +1,14 @@
-from pecan import expose, abort
+from pecan import expose, response
 
 from mita import checks
 
 
 class HealthController(object):
 
-    @expose()
+    @expose('json')
     def index(self):
-        if not checks.is_healthy():
-            abort(500)
+        # the checks run in the background, this only reads their results
+        report = checks.health_report()
+        if not report['healthy']:
+            response.status = 500
+        return report
@@ -0,0 +1,18 @@
+from pecan import expose
+
+from mita import metrics
+from mita.models.nodes import Node, NODE_STATES
+
+
+class MetricsController(object):
+
+    @expose(content_type='text/plain')
+    def index(self):
+        """
+        The metrics of every process in the Prometheus text format, along
+        with the count of nodes in every state of their lifecycle.
+        """
+        counts = Node.count_by_state()
+        for state in NODE_STATES:
+            metrics.gauge('nodes', state=state).set(counts.get(state, 0))
+        return metrics.render(metrics.collect())
@@ -1,14 +1,18 @@
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import uuid
 
-from pecan import expose, abort, request, conf
+from pecan import expose, abort, request
 from mita.models import Node
-from mita.tasks import delete_node
+from mita.models.nodes import label_signature
+from mita.tasks import delete_node, attach_storage
 from mita.connections import jenkins_connection
 from mita import providers, models
-from mita.util import NodeState, delete_jenkins_node, delete_provider_node
+from mita.util import (
+    NodeState, delete_jenkins_node, delete_provider_node, update_idle_state,
+    nodes_to_create, RECENT_NODE_SECONDS,
+)
 from mita.exceptions import CloudNodeNotFound
 
 logger = logging.getLogger(__name__)
@@ -32,10 +36,7 @@ class NodeController(object):
         """
         if not self.node:
             abort(404, 'could not find UUID: %s' % self.identifier)
-        if self.node.idle_since is None:
-            return
-        logger.info("Marking %s as active." % self.node.identifier)
-        self.node.idle_since = None
+        update_idle_state(self.node, False)
 
     @expose('json')
     def idle(self):
@@ -46,42 +47,9 @@ class NodeController(object):
         """
         if not self.node:
             abort(404, 'could not find UUID: %s' % self.identifier)
-        provider_for_node = conf.nodes[self.node.name]['provider']
-        provider = providers.get(provider_for_node)
         if request.method != 'POST':
             abort(405)
-        now = datetime.utcnow()
-        if self.node.idle:
-            # it was idle before so check how many seconds since it was lazy.
-            # `idle` is a property that will only be true-ish if idle_since has
-            # been set.
-            difference = now - self.node.idle_since
-
-            if difference.seconds > 2400:  # 40 minutes
-                # talk to Jenkins again, make sure this node didn't get picked
-                # up on its way here
-                conn = jenkins_connection()
-                if conn.node_exists(self.node.jenkins_name):
-                    if conn.get_node_info(self.node.jenkins_name).get('idle'):
-                        logger.info("[jenkins] removing node: %s" % self.node.jenkins_name)
-                        conn.delete_node(self.node.jenkins_name)
-                    else:
-                        logger.warning(
-                            'skipping deletion of node, no longer idle: %s',
-                            self.node.jenkins_name
-                        )
-                        return
-                # we need to terminate this couch potato
-                logger.info("[cloud] destroying node: %s" % self.node.cloud_name)
-                try:
-                    provider.destroy_node(name=self.node.cloud_name)
-                except CloudNodeNotFound:
-                    logger.info("node does not exist in cloud provider")
-                # delete from our database
-                self.node.delete()
-
-        else:  # mark it as being idle
-            self.node.idle_since = now
+        update_idle_state(self.node, True, jenkins_connection)
 
     @expose('json')
     def delete(self):
@@ -105,28 +73,130 @@ class NodeController(object):
         else:
             delete_provider_node(
                 providers.get(self.node.provider),
-                self.node.cloud_name
+                self.node.cloud_name,
+                self.node.provider_id,
+                self.node.volume_id,
+                self.node.storage,
             )
             delete_jenkins_node(self.node.jenkins_name)
             self.node.delete()
 
     @expose('json')
-    def status(self, **kw):
-        # since this is a read-only request via GET we need to ask for query
-        # args to determine the right node because the name alone is not good
-        # enoug (we might have more than one node named 'centos6' for example.
-        provider = providers.get(request.json['provider'])
-        status = provider.node_status(self.node_name, **kw)
+    def status(self):
+        if not self.node:
+            abort(404, 'could not find UUID: %s' % self.identifier)
+        provider = providers.get(self.node.provider)
+        try:
+            status = provider.node_status(
+                self.node.cloud_name,
+                provider_id=self.node.provider_id,
+            )
+        except CloudNodeNotFound:
+            abort(404, 'node does not exist in cloud provider: %s' % self.identifier)
         state = NodeState[status]
         state_int = NodeState[state]
         return {'status': state, 'status_int': state_int}
 
 
+def create_nodes(node_details, count):
+    """
+    Ask the provider for ``count`` new nodes at the same time, through its
+    worker pool, and record in the database only the ones that got created.
+
+    Node types configured with ``batch_boot`` are booted with a single API
+    call when the provider supports it, falling back to creating the remaining
+    nodes one by one.
+    """
+    provider_name = node_details['provider']
+    provider = providers.get(provider_name)
+    name = node_details['name']
+    created = 0
+    if count > 1 and node_details.get('batch_boot') and not node_details.get('storage'):
+        if hasattr(provider, 'create_nodes'):
+            created = batch_create_nodes(provider, node_details, count)
+        else:
+            logger.warning('provider %s can not boot nodes in a batch', provider_name)
+
+    new_nodes = []
+    for i in range(count - created):
+        # slap the UUID into the new node details
+        node_kwargs = deepcopy(node_details)
+        _id = str(uuid.uuid4())
+        node_kwargs['name'] = "%s__%s" % (name, _id)
+        node_kwargs['script'] = node_details['script'] % _id
+        new_nodes.append((_id, node_kwargs))
+
+    def create(new_node):
+        _id, node_kwargs = new_node
+        try:
+            return provider.create_node(**node_kwargs)
+        except Exception:
+            logger.exception('failed to create node: %s', node_kwargs['name'])
+
+    provider_ids = providers.get_pool(provider_name).map(create, new_nodes)
+
+    with_storage = []
+    for (_id, node_kwargs), provider_id in zip(new_nodes, provider_ids):
+        if not provider_id:
+            continue
+        node_kwargs.pop('name')
+        node = Node(
+            name=name,
+            identifier=_id,
+            provider_id=provider_id,
+            **node_kwargs
+        )
+        if node.storage:
+            with_storage.append(node)
+        created += 1
+    models.commit()
+    # volumes are created and attached in the background, the rows need to be
+    # committed before so that the tasks can find them
+    for node in with_storage:
+        attach_storage.delay(node.id)
+    if created < count:
+        logger.warning('only %s out of %s nodes were created', created, count)
+    return created
+
+
+def batch_create_nodes(provider, node_details, count):
+    """
+    Boot all the nodes with one call to the provider. The servers share the
+    same user data, so the ID the provider gives to each one is used as its
+    identifier (the script gets it from the server itself).
+
+    The provider renames the servers of a batch (``<name>-1``, ``<name>-2``,
+    and so on) so they can't be found by name, only nodes with the ID of their
+    server get recorded.
+    """
+    node_kwargs = deepcopy(node_details)
+    # the count in the request is what the job needs, not what gets booted
+    node_kwargs.pop('count', None)
+    try:
+        server_ids = provider.create_nodes(count, **node_kwargs)
+    except Exception:
+        logger.exception('failed to create %s nodes in a batch', count)
+        return 0
+    node_kwargs.pop('name')
+    created = 0
+    for server_id in server_ids:
+        if not server_id:
+            logger.error('provider did not return the ID of a server booted in a batch')
+            continue
+        Node(
+            name=node_details['name'],
+            identifier=server_id,
+            provider_id=server_id,
+            **node_kwargs
+        )
+        created += 1
+    return created
+
+
 class NodesController(object):
 
     @expose('json')
     def index(self):
-        provider = providers.get(request.json['provider'])
         # request.json is read-only, since we are going to add extra metadata
         # to get the classes created, make a clean copy
         _json = deepcopy(request.json)
@@ -139,14 +209,6 @@ class NodesController(object):
         labels = _json['labels']
         script = _json['script']
         count = _json.get('count', 1)
-        # a buffered count is 3/4 what is needed rounded up
-        buffered_count = int(round(count * 0.75))
-        existing_nodes = Node.filter_by(
-            name=name,
-            keyname=keyname,
-            image_name=image_name,
-            size=size,
-        ).all()
 
         # try to slap it into the script, it is not OK if we are not allowed to, assume we should
         # this is just a validation step, should be taken care of by proper schema validation.
@@ -160,67 +222,83 @@ class NodesController(object):
             return  # do not add anything if we haven't been able to format
 
         logger.info('checking if an existing node matches required labels: %s', str(labels))
-        matching_nodes = [n for n in existing_nodes if n.labels_match(labels)]
-        if not matching_nodes:  # we don't have anything that matches this that has been ever created
-            logger.info('job needs %s nodes to get unstuck', count)
+        # count the existing nodes with the same labels (and how many of them
+        # were created recently) with one (indexed) aggregate query
+        signature = label_signature(labels)
+        cutoff = datetime.utcnow() - timedelta(seconds=RECENT_NODE_SECONDS)
+        counts = Node.count_by_type(
+            cutoff,
+            name=name,
+            keyname=keyname,
+            image_name=image_name,
+            size=size,
+            label_signature=signature,
+        )
+        existing, recent = counts.get((name, signature), (0, 0))
+        logger.info('job needs %s nodes to get unstuck', count)
+        to_create = nodes_to_create(count, existing, recent)
+        if not to_create:
             logger.info(
-                'no matching nodes were found, will create new ones. count: %s',
-                buffered_count
+                'but there are %s node(s) already created 6 minutes ago', recent
             )
-            for i in range(buffered_count):
-                # slap the UUID into the new node details
-                node_kwargs = deepcopy(request.json)
-                _id = str(uuid.uuid4())
-                node_kwargs['name'] = "%s__%s" % (name, _id)
-                node_kwargs['script'] = script % _id
-
-                provider.create_node(**node_kwargs)
-                node_kwargs.pop('name')
-                Node(
-                    name=name,
-                    identifier=_id,
-                    **node_kwargs
-                )
-                models.commit()
+            logger.info('will not create one')
+            return
+        if not existing:  # we don't have anything that matches this that has been ever created
+            logger.info('no matching nodes were found, will create new ones. count: %s', to_create)
         else:
-            logger.info('found existing nodes that match labels: %s', len(matching_nodes))
-            now = datetime.utcnow()
-            # we have something that matches, go over all of them and check:
-            # if *all of them* are over 6 (by default) minutes since creation.
-            # that means that they are probably busy, so create a new one
-            already_created_nodes = 0
-            for n in matching_nodes:
-                difference = now - n.created
-                if difference.seconds < 360:  # 6 minutes
-                    already_created_nodes += 1
-            if already_created_nodes >= count:
-                logger.info('job needs %s nodes to get unstuck', count)
-                logger.info(
-                    'but there are %s node(s) already created 6 minutes ago',
-                    already_created_nodes
-                )
-                logger.info('will not create one')
-                return
-            logger.info('job needs %s nodes to get unstuck', count)
+            logger.info('found existing nodes that match labels: %s', existing)
             logger.info(
                 'no nodes created recently enough, will create new ones. count: %s',
-                buffered_count
+                to_create
             )
-            for i in range(buffered_count):
-                # slap the UUID into the new node details
-                node_kwargs = deepcopy(request.json)
-                _id = str(uuid.uuid4())
-                node_kwargs['name'] = "%s__%s" % (name, _id)
-                node_kwargs['script'] = script % _id
-
-                provider.create_node(**node_kwargs)
-                node_kwargs.pop('name')
-                Node(
-                    name=name,
-                    identifier=_id,
-                    **node_kwargs
-                )
-                models.commit()
+        create_nodes(request.json, to_create)
+
+    @expose('json')
+    def states(self):
+        """
+        Report the idle or active state of many nodes in a single request. The
+        body is a list of entries like::
+
+            [{"identifier": "8a1c...", "state": "idle"},
+             {"identifier": "3f2b...", "state": "active"}]
+
+        Each entry is handled like a request to the ``idle`` or ``active``
+        endpoint of that node, and the response has the result for each one:
+        'idle', 'active', 'destroyed', 'unchanged', 'not found' or 'invalid'.
+        """
+        if request.method != 'POST':
+            abort(405)
+        try:
+            entries = request.json
+        except ValueError:
+            entries = None
+        if not isinstance(entries, list):
+            abort(400, 'expected a list of node states')
+
+        identifiers = [e.get('identifier') for e in entries if isinstance(e, dict)]
+        nodes = dict(
+            (n.identifier, n) for n in Node.query.filter(Node.identifier.in_(identifiers))
+        ) if identifiers else {}
+        now = datetime.utcnow()
+        results = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                results.append({'identifier': None, 'result': 'invalid'})
+                continue
+            identifier = entry.get('identifier')
+            node = nodes.get(identifier)
+            if entry.get('state') not in ('idle', 'active'):
+                result = 'invalid'
+            elif node is None:
+                result = 'not found'
+            else:
+                result = update_idle_state(
+                    node, entry['state'] == 'idle', jenkins_connection, now=now
+                ) or 'unchanged'
+                if result == 'destroyed':
+                    nodes.pop(identifier)
+            results.append({'identifier': identifier, 'result': result})
+        return {'nodes': results}
 
     @expose('json')
     def _lookup(self, node_name, *remainder):
@@ -1,5 +1,5 @@
 from pecan import expose
-from mita.controllers import nodes, health
+from mita.controllers import nodes, health, metrics
 
 
 class ApiController(object):
@@ -15,3 +15,4 @@ class RootController(object):
 
     api = ApiController()
     health = health.HealthController()
+    metrics = metrics.MetricsController()
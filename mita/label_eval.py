@@ -1,6 +1,8 @@
 import ast
 import logging
 import re
+import threading
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -76,53 +78,197 @@ def validate_and_parse(expr):
     ast's NodeVisitor class, while validating expr for safety.
     Returns a set() of all noted names.
     '''
+    return parse(expr)[1]
+
+
+def parse(expr):
+    '''
+    Parse and validate expr, returning a tuple of the ast tree and the set()
+    of names in it. The tree is None when expr is not valid or not safe.
+    '''
     try:
         tree = ast.parse(expr)
     except SyntaxError as e:
         log.warning(e)
-        return set()
+        return None, set()
 
     visitor = myvisitor()
     try:
         visitor.visit(tree)
     except UnsafeNodeType as e:
         log.warning(e)
-        return set()
+        return None, set()
+
+    return tree, visitor.names
+
+
+class NodeBitsets(object):
+    '''
+    The labels of configured nodes as bitsets: every node gets a bit (in the
+    order of the configuration) and every label maps to the bits of the nodes
+    that have it. A compiled expression is then evaluated once for all the
+    nodes with bitwise operations.
+    '''
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.names = list()
+        self.masks = dict()
+        for nodename, metadata in nodes.iteritems():
+            bit = 1 << len(self.names)
+            self.names.append(nodename)
+            for label in metadata['labels']:
+                self.masks[label] = self.masks.get(label, 0) | bit
+        self.all = (1 << len(self.names)) - 1
+
+    def nodes_in(self, mask):
+        '''Returns the list of nodes whose bit is set in mask'''
+        return [name for i, name in enumerate(self.names) if mask >> i & 1]
 
-    return visitor.names
+
+class LabelMatcher(object):
+    '''
+    A compiled label expression, that can be reused with any NodeBitsets
+    '''
+
+    def __init__(self, expr, names, evaluate):
+        self.expr = expr
+        self.names = names
+        self._evaluate = evaluate
+
+    def match(self, bitsets):
+        '''Returns the mask of the nodes in bitsets that match'''
+        return self._evaluate(bitsets.masks, bitsets.all)
+
+
+def _compile_node(node):
+    '''
+    Turn a (validated) ast node into a function of the label masks and the
+    mask of all nodes that evaluates it
+    '''
+    if isinstance(node, ast.Name):
+        name = node.id
+        return lambda masks, everything: masks.get(name, 0)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = _compile_node(node.operand)
+        return lambda masks, everything: everything & ~operand(masks, everything)
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_node(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate(masks, everything):
+                mask = everything
+                for value in values:
+                    mask &= value(masks, everything)
+                return mask
+        else:
+            def evaluate(masks, everything):
+                mask = 0
+                for value in values:
+                    mask |= value(masks, everything)
+                return mask
+        return evaluate
+
+    raise UnsafeNodeType(node.__class__.__name__)
+
+
+def _compile(expr):
+    tree, names = parse(pythonize_boolean(expr))
+    if not names or len(tree.body) != 1:
+        return None
+    try:
+        evaluate = _compile_node(tree.body[0].value)
+    except UnsafeNodeType as e:
+        log.warning(e)
+        return None
+    return LabelMatcher(expr, names, evaluate)
+
+
+class LRUCache(object):
+    '''
+    A small, thread safe, least recently used cache
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# how many compiled expressions are kept around
+CACHE_SIZE = 256
+
+_matchers = LRUCache(CACHE_SIZE)
+_missing = object()
+
+
+def compile_expr(expr):
+    '''
+    Returns the LabelMatcher for the Jenkins label expression expr, or None
+    if it is not a valid expression. Compiled expressions are cached by the
+    expression string, since the same ones show up on every check of the
+    queue.
+    '''
+    matcher = _matchers.get(expr, _missing)
+    if matcher is _missing:
+        matcher = _compile(expr)
+        _matchers.set(expr, matcher)
+    return matcher
+
+
+# the bitsets for the last nodes used, the configured nodes do not change
+# until the configuration is loaded again
+_bitsets = (None, None)
+
+
+def node_bitsets(nodes):
+    '''
+    Returns the NodeBitsets for nodes, reusing the last ones if nodes is the
+    same (unmodified) mapping
+    '''
+    global _bitsets
+    source, bitsets = _bitsets
+    if bitsets is None or source is not nodes:
+        bitsets = NodeBitsets(nodes)
+        _bitsets = (nodes, bitsets)
+    return bitsets
 
 
 def matching_nodes(expr, nodes):
     '''Returns a list of nodes that match expr'''
-    # return value
-    matching_nodes = list()
-
-    expr = pythonize_boolean(expr)
-
-    # collect all expr's names
-    names = validate_and_parse(expr)
-    if not names:
-        return matching_nodes
-
-    # all the names in expr, initialized to "False"
-    symdict = {k: False for k in names}
-
-    for nodename, metadata in nodes.iteritems():
-        # copy for this particular slave
-        localdict = dict(symdict)
-
-        # Note labels supplied by nodename as 'True' in localdict
-        # (we could limit this only to labels that already
-        # exist in the expression, but there's not much point;
-        # if the expression doesn't care it doesn't care in the
-        # eval() below either)
-        for label in metadata['labels']:
-            localdict[label] = True
-
-        # localdict is now the intersection of labels mentioned in expr
-        # and labels supplied by node, with True/False set
-        # appropriately for this node.
-        if eval(expr, globals(), localdict) is True:
-            matching_nodes.append(nodename)
-
-    return matching_nodes
+    matcher = compile_expr(expr)
+    if matcher is None:
+        return list()
+    bitsets = node_bitsets(nodes)
+    return bitsets.nodes_in(matcher.match(bitsets))
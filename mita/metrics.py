@@ -0,0 +1,442 @@
+"""
+Minimal, in-process, metrics that can be used to get some visibility on how
+long things take without having to dig through log lines.
+
+Every process (API workers and Celery workers alike) saves its metrics to a
+file named after its pid in a shared directory, from a background thread and
+when a Celery task finishes, so that they can be combined and exposed in the
+Prometheus text format by any of them. The totals of a process that is gone
+are taken over by the next one that combines them (or that gets its pid), so
+its file doesn't stay behind and the totals don't go back.
+"""
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from pecan import conf
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds, in seconds, for the histogram buckets
+DEFAULT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+# buckets for the latency of calls to other services
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# metrics are prefixed with this when exposed
+PREFIX = 'mita_'
+
+# how often (in seconds) the metrics of a process are saved in the background
+SAVE_INTERVAL = 10
+
+
+class Histogram(object):
+    """
+    Counts observed values into cumulative buckets (each bucket counts the
+    values less or equal than its bound) while keeping a total count and sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * len(self.buckets)
+            self.count = 0
+            self.sum = 0
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'buckets': dict(zip(self.buckets, self.counts)),
+                'count': self.count,
+                'sum': self.sum,
+            }
+
+    def record(self):
+        with self._lock:
+            return {
+                'buckets': [list(bucket) for bucket in zip(self.buckets, self.counts)],
+                'count': self.count,
+                'sum': self.sum,
+            }
+
+    def merge(self, record):
+        """
+        Add the counts of a ``record`` saved by another process
+        """
+        counts = dict((bound, count) for bound, count in record['buckets'])
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                self.counts[i] += counts.get(bound, 0)
+            self.count += record['count']
+            self.sum += record['sum']
+
+
+class Counter(object):
+    """
+    A value that only goes up.
+    """
+    type = 'counter'
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def record(self):
+        with self._lock:
+            return {'value': self.value}
+
+    def merge(self, record):
+        self.inc(record['value'])
+
+
+class Gauge(object):
+    """
+    A value that is set to whatever it currently is. When combined with the
+    ones from other processes, the value saved last wins.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def record(self):
+        with self._lock:
+            return {'value': self.value}
+
+
+# metrics by name and labels
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _get(cls, name, labels, *args):
+    start_saver()
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = _metrics[key] = cls(name, *args, labels=labels)
+    return metric
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS, **labels):
+    """
+    Get (creating it if needed) the histogram registered for ``name`` and
+    ``labels``
+    """
+    return _get(Histogram, name, labels, buckets)
+
+
+def counter(name, **labels):
+    return _get(Counter, name, labels)
+
+
+def gauge(name, **labels):
+    return _get(Gauge, name, labels)
+
+
+def family(name):
+    """
+    Every metric registered for ``name``, whatever their labels are
+    """
+    with _metrics_lock:
+        return [metric for (key, labels), metric in _metrics.items() if key == name]
+
+
+@contextmanager
+def timer(name, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Observe how long (in seconds) the block took, even if it raised.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        histogram(name, buckets, **labels).observe(time.time() - start)
+
+
+def timed(name, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Decorator version of ``timer``
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            with timer(name, buckets, **labels):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    All the metrics of this process, in a form that can be saved as JSON
+    """
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    records = []
+    for metric in metrics:
+        record = metric.record()
+        record.update(type=metric.type, name=metric.name, labels=metric.labels)
+        records.append(record)
+    return records
+
+
+def metrics_dir():
+    """
+    Where every process saves its metrics, set with the ``path`` key of the
+    ``metrics`` configuration.
+    """
+    default = os.path.join(tempfile.gettempdir(), 'mita-metrics')
+    return conf.get('metrics', {}).get('path', default)
+
+
+def gauge_max_age():
+    """
+    Gauges saved longer than this many seconds ago are left out when the
+    metrics are combined, set with the ``gauge_max_age`` key of the
+    ``metrics`` configuration.
+    """
+    return conf.get('metrics', {}).get('gauge_max_age', 600)
+
+
+def _read(name):
+    try:
+        with open(name) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logger.warning('unable to read metrics from: %s', name)
+
+
+def take_over(name):
+    """
+    Add the histograms and counters saved in ``name``, by a process that is
+    gone, to the ones of this process and remove the file. Its gauges are
+    dropped, they mean nothing without the process that set them. Returns
+    ``False`` if another process took it over first.
+    """
+    taken = '%s.%s.taken' % (name, os.getpid())
+    try:
+        os.rename(name, taken)
+    except OSError:
+        return False
+    saved = _read(taken)
+    os.remove(taken)
+    for record in (saved or {}).get('metrics', []):
+        if record['type'] == 'histogram':
+            buckets = [bound for bound, count in record['buckets']]
+            histogram(record['name'], buckets, **record['labels']).merge(record)
+        elif record['type'] == 'counter':
+            counter(record['name'], **record['labels']).merge(record)
+    return True
+
+
+# the pid that this process saved its metrics with last
+_saved_pid = None
+
+
+def save():
+    """
+    Save the metrics of this process, replacing the ones it saved before.
+    """
+    global _saved_pid
+    path = metrics_dir()
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another process created it first
+            if not os.path.isdir(path):
+                raise
+    name = os.path.join(path, '%s.json' % os.getpid())
+    if _saved_pid != os.getpid():
+        _saved_pid = os.getpid()
+        # a process that is gone had the same pid
+        if os.path.exists(name):
+            take_over(name)
+    tmp = '%s.%s.tmp' % (name, threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        json.dump({'saved': time.time(), 'metrics': snapshot()}, f)
+    os.rename(tmp, name)
+
+
+def _save_every(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            save()
+        except Exception:
+            logger.exception('unable to save metrics')
+
+
+# the pid that the thread saving the metrics in the background was started
+# for, a forked worker doesn't get the thread of its parent so it needs to
+# start its own
+_saver_pid = None
+_saver_lock = threading.Lock()
+
+
+def start_saver():
+    """
+    Save the metrics every ``SAVE_INTERVAL`` seconds in the background, so
+    that recording them never waits on the disk.
+    """
+    global _saver_pid
+    if _saver_pid == os.getpid():
+        return
+    with _saver_lock:
+        if _saver_pid != os.getpid():
+            saver = threading.Thread(
+                target=_save_every, args=(SAVE_INTERVAL,), name='metrics-saver')
+            saver.daemon = True
+            saver.start()
+            _saver_pid = os.getpid()
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _combine(sources):
+    """
+    Combine the records of every ``(saved, records)`` source: histograms and
+    counters are added up, while gauges keep the value that was saved last.
+    """
+    combined = {}
+    for saved, records in sources:
+        for record in records:
+            key = (record['name'], tuple(sorted(record['labels'].items())))
+            current = combined.get(key)
+            if current is None:
+                current = combined[key] = dict(record, saved=saved)
+                if record['type'] == 'histogram':
+                    current['buckets'] = [list(bucket) for bucket in record['buckets']]
+            elif record['type'] == 'histogram':
+                counts = dict((bound, count) for bound, count in record['buckets'])
+                for bucket in current['buckets']:
+                    bucket[1] += counts.get(bucket[0], 0)
+                current['count'] += record['count']
+                current['sum'] += record['sum']
+            elif record['type'] == 'counter':
+                current['value'] += record['value']
+            elif saved > current['saved']:
+                current.update(value=record['value'], saved=saved)
+    return sorted(combined.values(), key=lambda r: (r['name'], sorted(r['labels'].items())))
+
+
+def collect():
+    """
+    Combine the metrics of this process with the ones saved by every other
+    process (see ``_combine``), taking over the ones of the processes that
+    are gone first. Gauges saved longer than ``gauge_max_age`` seconds ago
+    are left out.
+    """
+    path = metrics_dir()
+    names = os.listdir(path) if os.path.isdir(path) else []
+    names = [name for name in names if name.endswith('.json')]
+    own = '%s.json' % os.getpid()
+    taken = False
+    for name in names:
+        try:
+            pid = int(name[:-len('.json')])
+        except ValueError:
+            continue
+        if name != own and not _is_running(pid):
+            taken = take_over(os.path.join(path, name)) or taken
+    if taken:
+        # so that the totals are not lost if this process goes away now
+        save()
+
+    now = time.time()
+    sources = [(now, snapshot())]
+    for name in names:
+        if name == own or not os.path.exists(os.path.join(path, name)):
+            continue
+        saved = _read(os.path.join(path, name))
+        if saved is None:
+            continue
+        records = saved['metrics']
+        if now - saved['saved'] > gauge_max_age():
+            records = [record for record in records if record['type'] != 'gauge']
+        sources.append((saved['saved'], records))
+    return _combine(sources)
+
+
+def _labels(labels, **extra):
+    # ``le`` (the bound of a histogram bucket) goes last
+    labels = sorted(labels.items()) + sorted(extra.items())
+    if not labels:
+        return u''
+    escaped = (
+        (k, unicode(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+        for k, v in labels
+    )
+    return u'{%s}' % u','.join(u'%s="%s"' % pair for pair in escaped)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(records):
+    """
+    The (collected) metrics in the Prometheus text format, encoded as UTF-8
+    """
+    lines = []
+    seen = set()
+    for record in records:
+        name = PREFIX + record['name']
+        if name not in seen:
+            seen.add(name)
+            lines.append(u'# TYPE %s %s' % (name, record['type']))
+        labels = record['labels']
+        if record['type'] == 'histogram':
+            for bound, count in record['buckets']:
+                lines.append(u'%s_bucket%s %s' % (name, _labels(labels, le=_number(bound)), count))
+            lines.append(u'%s_bucket%s %s' % (name, _labels(labels, le='+Inf'), record['count']))
+            lines.append(u'%s_sum%s %s' % (name, _labels(labels), _number(record['sum'])))
+            lines.append(u'%s_count%s %s' % (name, _labels(labels), record['count']))
+        else:
+            lines.append(u'%s%s %s' % (name, _labels(labels), _number(record['value'])))
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
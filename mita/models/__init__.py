@@ -96,6 +96,14 @@ def rollback():
     Session.rollback()
 
 
+def begin_nested():
+    """
+    Start a savepoint, so that the changes since then can be rolled back on
+    their own.
+    """
+    return Session.begin_nested()
+
+
 def clear():
     Session.remove()
     Session.close()
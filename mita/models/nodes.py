@@ -1,14 +1,37 @@
 import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+import hashlib
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy import func, case
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.exc import DetachedInstanceError
-from mita.models import Base
+from mita.models import Base, Session
 from mita.util import get_jenkins_name
 
 
+def label_signature(labels):
+    """
+    A fingerprint of a set of labels, that doesn't depend on their order or on
+    repeated labels, so that nodes with the same labels can be found with an
+    equality comparison.
+    """
+    canonical = u'\n'.join(sorted(set(labels or [])))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+# the states of the lifecycle of a node, see ``Node.count_by_state``
+NODE_STATES = ('provisioning', 'failed', 'idle', 'active')
+
+
 class Node(Base):
 
     __tablename__ = 'nodes'
+    __table_args__ = (
+        # the lookup for existing nodes of a given type and labels
+        Index(
+            'ix_nodes_label_lookup',
+            'name', 'keyname', 'image_name', 'size', 'label_signature', 'created',
+        ),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(256), nullable=False, index=True)
     created = Column(DateTime, index=True)
@@ -18,8 +41,22 @@ class Node(Base):
     identifier = Column(String(128), nullable=False, unique=True, index=True)
     idle_since = Column(DateTime)
     provider = Column(String(128))
+    # the ID of the server in the provider, not available for nodes created
+    # before it started to get recorded
+    provider_id = Column(String(128), index=True)
+    # size in gigabytes of the volume attached to the node (if any) which is
+    # created asynchronously: ``storage_state`` tracks the progress from
+    # 'pending' to 'creating' and then 'attached' (or 'failed'). Nodes
+    # without a volume have 0, it is NULL for the ones created before this
+    # started to get recorded (which might have one)
+    storage = Column(Integer)
+    volume_id = Column(String(128))
+    storage_state = Column(String(32))
+    # see ``label_signature``
+    label_signature = Column(String(40))
 
-    def __init__(self, name, keyname, image_name, size, identifier, provider, labels=None, **kw):
+    def __init__(self, name, keyname, image_name, size, identifier, provider,
+                 labels=None, provider_id=None, storage=None, **kw):
         self.name = name
         self.keyname = keyname
         self.image_name = image_name
@@ -28,19 +65,47 @@ class Node(Base):
         self.created = datetime.datetime.utcnow()
         self.idle_since = None
         self.provider = provider
+        self.provider_id = provider_id
+        self.storage = storage or 0
+        if storage:
+            self.storage_state = 'pending'
+        self.label_signature = label_signature(labels)
         if labels:
             for l in labels:
                 Label(self, l)
 
-    def labels_match(self, labels):
+    @classmethod
+    def count_by_type(cls, cutoff, **filters):
+        """
+        Count the nodes (that match ``filters``) of every type, and how many of
+        them were created after ``cutoff``, with a single aggregate query.
+        Returns a mapping of ``(name, label_signature)`` to a tuple of
+        ``(existing, recent)`` counts.
+        """
+        recent = func.sum(case([(cls.created > cutoff, 1)], else_=0))
+        rows = Session.query(
+            cls.name, cls.label_signature, func.count(cls.id), recent
+        ).filter_by(**filters).group_by(cls.name, cls.label_signature)
+        return dict(
+            ((name, signature), (existing, int(recent or 0)))
+            for name, signature, existing, recent in rows
+        )
+
+    @classmethod
+    def count_by_state(cls):
         """
-        Get a list of labels and see if this Node has them all
-        Returns a boolean
+        Count the nodes in every state of their lifecycle with a single
+        query. Nodes are 'provisioning' while their volume is getting
+        attached (or 'failed' if it couldn't be), and then 'idle' or 'active'
+        as reported by Jenkins.
         """
-        for l in self.labels:
-            if l.name not in labels:
-                return False
-        return True
+        state = case([
+            (cls.storage_state.in_(['pending', 'creating']), 'provisioning'),
+            (cls.storage_state == 'failed', 'failed'),
+            (cls.idle_since.isnot(None), 'idle'),
+        ], else_='active').label('state')
+        rows = Session.query(state, func.count(cls.id)).group_by('state')
+        return dict(rows)
 
     @property
     def cloud_name(self):
@@ -48,9 +113,7 @@ class Node(Base):
 
     @property
     def jenkins_name(self):
-        if not hasattr(self, "_jenkins_name"):
-            self._jenkins_name = get_jenkins_name(self.identifier)
-        return self._jenkins_name
+        return get_jenkins_name(self.identifier)
 
     @property
     def idle(self):
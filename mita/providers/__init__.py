@@ -1,9 +1,16 @@
 import logging
+from multiprocessing.pool import ThreadPool
+from pecan import conf
 import openstack
 
 
 logger = logging.getLogger(__name__)
 
+# worker pools used to create (or destroy) nodes concurrently, one for each
+# provider. They live as long as the process so that each worker can reuse its
+# connection to the provider.
+_pools = {}
+
 
 def get(backend):
     module = _get_provider(backend)
@@ -14,6 +21,19 @@ def get(backend):
     return module
 
 
+def get_pool(backend):
+    """
+    Return the worker pool for a provider. Its size (how many nodes can be
+    created at the same time) is set with the ``max_parallel_creates`` key of
+    the provider configuration and defaults to 4.
+    """
+    pool = _pools.get(backend)
+    if pool is None:
+        size = conf.provider[backend].get('max_parallel_creates', 4)
+        pool = _pools[backend] = ThreadPool(size)
+    return pool
+
+
 def _get_provider(backend):
     if not backend:
         return
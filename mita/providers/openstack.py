@@ -1,12 +1,19 @@
+import base64
 import logging
-from libcloud.compute.types import Provider
+from datetime import datetime
+from functools import wraps
+from libcloud.common.exceptions import BaseHTTPError
+from libcloud.compute.base import Node, NodeImage, NodeSize, StorageVolume
+from libcloud.compute.types import NodeState, Provider
 from libcloud.compute.providers import get_driver
-from time import sleep
+from time import time
 import socket
+import threading
 from ssl import SSLError
 import libcloud.security
 from pecan import conf
 
+from mita import metrics
 from mita.exceptions import CloudNodeNotFound
 
 logger = logging.getLogger(__name__)
@@ -31,7 +38,56 @@ libcloud.security.VERIFY_SSL_CERT = False
 OpenStack = get_driver(Provider.OPENSTACK)
 
 
+# Drivers are kept around for the lifetime of the process, keyed on the
+# credentials used to build them, so that every call does not need to go
+# through a brand new Keystone authentication. libcloud connections are not
+# thread safe, so every thread (like the ones creating nodes in parallel) gets
+# its own.
+_local = threading.local()
+driver_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _drivers():
+    if not hasattr(_local, 'drivers'):
+        _local.drivers = {}
+    return _local.drivers
+
+
+def _driver_key():
+    return (
+        conf.provider.openstack.username,
+        conf.provider.openstack.auth_url,
+        conf.provider.openstack.tenant_name,
+        conf.provider.openstack.service_region,
+    )
+
+
+def _token_is_valid(driver):
+    """
+    libcloud authenticates lazily, on the first request made with the driver,
+    so a driver that hasn't talked to the API yet is considered valid.
+    """
+    auth_connection = getattr(driver.connection, '_osa', None)
+    if auth_connection is None or auth_connection.auth_token is None:
+        return True
+    return auth_connection.is_token_valid()
+
+
 def get_driver():
+    """
+    Return an OpenStack driver for the configured credentials, reusing (along
+    with its auth token) the one that was previously built by this process
+    unless the token has expired.
+    """
+    key = _driver_key()
+    driver = _drivers().get(key)
+    if driver is not None and _token_is_valid(driver):
+        driver_cache_stats['hits'] += 1
+        return driver
+
+    driver_cache_stats['misses'] += 1
+    if driver is not None:
+        logger.info('auth token for cached driver expired, will re-authenticate')
     driver = OpenStack(
         conf.provider.openstack.username,
         conf.provider.openstack.password,
@@ -40,42 +96,230 @@ def get_driver():
         ex_tenant_name=conf.provider.openstack.tenant_name,
         ex_force_service_region=conf.provider.openstack.service_region,
     )
+    _drivers()[key] = driver
     return driver
 
 
+def invalidate_driver():
+    """
+    Drop the drivers cached for the current thread so that the next
+    ``get_driver()`` call authenticates again.
+    """
+    _drivers().clear()
+
+
+def timed(operation):
+    """
+    Record how long the calls to the API for ``operation`` take
+    """
+    return metrics.timed(
+        'provider_request_seconds', provider='openstack', operation=operation)
+
+
+def reauthenticate_on_failure(func):
+    """
+    A cached token can be revoked before it expires, in which case the API
+    responds with a 401. Drop the cached driver and retry the call (once) with
+    a freshly authenticated one.
+    """
+    @wraps(func)
+    def wrapper(*args, **kw):
+        try:
+            return func(*args, **kw)
+        except BaseHTTPError as error:
+            # libcloud raises ``InvalidCredsError`` only when authenticating,
+            # an API call with a revoked token gets a plain 401
+            if error.code != 401:
+                raise
+            logger.warning('provider rejected the auth token, will re-authenticate')
+            invalidate_driver()
+            return func(*args, **kw)
+    return wrapper
+
+
+# The servers in the tenant, listed once and indexed by name and by ID so that
+# purging, destroying, and looking up nodes don't list them every time.
+# ``check_orphaned`` lists them again at the start of every run, otherwise a
+# listing is used for ``inventory_ttl`` seconds (configurable in the provider
+# section).
+_inventory = {'by_name': {}, 'by_id': {}, 'expires': 0}
+
+
+def invalidate_inventory(provider_id=None):
+    """
+    Forget the listed servers so that the next lookup goes to the API again,
+    or only the one with ``provider_id`` when it is known to be gone.
+    """
+    if provider_id is None:
+        _inventory.update(by_name={}, by_id={}, expires=0)
+        return
+    node = _inventory['by_id'].pop(provider_id, None)
+    if node is not None and _inventory['by_name'].get(node.name) is node:
+        del _inventory['by_name'][node.name]
+
+
+@timed('list')
+@reauthenticate_on_failure
+def refresh_inventory():
+    """
+    List every server in the tenant with a single API call, replacing the
+    previous listing.
+    """
+    by_name = {}
+    by_id = {}
+    for node in get_driver().list_nodes():
+        # keep the first match for duplicated names, like a lookup in the API
+        # listing would
+        by_name.setdefault(node.name, node)
+        by_id[node.id] = node
+    ttl = conf.provider.openstack.get('inventory_ttl', 60)
+    _inventory.update(by_name=by_name, by_id=by_id, expires=time() + ttl)
+
+
+def get_inventory(refresh=False):
+    """
+    The servers in the tenant as a ``(by_name, by_id)`` tuple, listed again
+    if the listing expired or ``refresh`` is requested.
+    """
+    if refresh or time() > _inventory['expires']:
+        refresh_inventory()
+    return _inventory['by_name'], _inventory['by_id']
+
+
+def find_node(name, refresh_on_miss=True):
+    """
+    Look up a server by name in the listing. A server could've been created
+    after it was listed, so a miss lists the servers again unless
+    ``refresh_on_miss`` is ``False``.
+    """
+    by_name, by_id = get_inventory()
+    node = by_name.get(name)
+    if node is None and refresh_on_miss:
+        by_name, by_id = get_inventory(refresh=True)
+        node = by_name.get(name)
+    return node
+
+
+def in_error_state(node):
+    # it used to be the case that 'state' would be an integer, and that
+    # OVH would slap a 7 for a node in ERROR. Somehow the __repr__ of the object
+    # will contain that, so try that too
+    error_integer = node.state == 7
+    error_repr = 'state=ERROR' in str(node)
+    error_string = node.state == 'error'
+    return error_integer or error_repr or error_string
+
+
+def server_created(node):
+    """
+    When the server was created (in UTC) according to the API, or ``None`` if
+    that is not known.
+    """
+    try:
+        return datetime.strptime(node.extra['created'], '%Y-%m-%dT%H:%M:%SZ')
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+@reauthenticate_on_failure
 def purge():
     """
     Get rid of nodes in Error state
     """
     driver = get_driver()
-    nodes = driver.list_nodes()
+    by_name, by_id = get_inventory()
     logger.info('looking for nodes in error state for removal')
     destroyed = 0
-    for node in nodes:
-        # it used to be the case that 'state' would be an integer, and that
-        # OVH would slap a 7 for a node in ERROR. Somehow the __repr__ of the object
-        # will contain that, so try that too
-        error_integer = node.state == 7
-        error_repr = 'state=ERROR' in str(node)
-        error_string = node.state == 'error'
-        if error_integer or error_repr or error_string:
-            destroyed += 1
+    for node in list(by_id.values()):
+        if in_error_state(node):
             logger.info('destroying node in error state: %s', str(node))
-            node.destroy()
+            # the listing could come from another thread, use the driver of
+            # this one rather than the one the node was listed with
+            try:
+                driver.destroy_node(node)
+            except BaseHTTPError as error:
+                # the listing can be older than the last time it got deleted
+                if error.code != 404:
+                    raise
+                logger.info('node in error state no longer exists: %s', str(node))
+                continue
+            finally:
+                invalidate_inventory(node.id)
+            destroyed += 1
     if destroyed:
         logger.warning('%s nodes destroyed that were found in error state' % destroyed)
         return True
     logger.info('no nodes found in error state, nothing was destroyed')
 
 
+@timed('create')
 def create_node(**kw):
+    """
+    Ask the provider for a new server, returning the ID assigned to it (or
+    ``None`` if it could not be created) as soon as the request is accepted.
+    Storage is not handled here, see ``mita.tasks.attach_storage``.
+    """
+    new_node = _boot_node(**kw)
+    if new_node:
+        invalidate_inventory()
+        return new_node.id
+
+
+# Image and size names map to IDs that almost never change, keep that mapping
+# around for ``catalog_ttl`` seconds (configurable in the provider section)
+# instead of listing every image and flavor for each node that gets created.
+_catalog = {'images': {}, 'sizes': {}, 'expires': 0}
+
+
+def invalidate_catalog():
+    """
+    Forget the cached image and size IDs so that the next lookup goes to the
+    API again.
+    """
+    _catalog.update(images={}, sizes={}, expires=0)
+
+
+def _refresh_catalog(driver):
+    images = {}
+    sizes = {}
+    # keep the first match for duplicated names, like the API listing would
+    for image in driver.list_images():
+        images.setdefault(image.name, image.id)
+    for size in driver.list_sizes():
+        sizes.setdefault(size.name, size.id)
+    ttl = conf.provider.openstack.get('catalog_ttl', 3600)
+    _catalog.update(images=images, sizes=sizes, expires=time() + ttl)
+
+
+def lookup_catalog(driver, image_name, size_name, refresh=False):
+    """
+    Map an image name and a size name to their IDs in the provider, returning
+    a tuple of ``(image_id, size_id, refreshed)``. The catalog is fetched again
+    if it expired, if ``refresh`` is requested, or if a name is not in it (an
+    image could've been uploaded recently). ``refreshed`` tells the caller
+    whether the IDs come straight from the API.
+    """
+    refreshed = False
+    if refresh or time() > _catalog['expires']:
+        _refresh_catalog(driver)
+        refreshed = True
+    image_id = _catalog['images'].get(image_name)
+    size_id = _catalog['sizes'].get(size_name)
+    if not refreshed and (image_id is None or size_id is None):
+        return lookup_catalog(driver, image_name, size_name, refresh=True)
+    return image_id, size_id, refreshed
+
+
+@reauthenticate_on_failure
+def _boot_node(**kw):
+    """
+    Look up the image and size and ask the provider for a new server.
+    """
     name = kw['name']
     driver = get_driver()
-    images = driver.list_images()
-    sizes = driver.list_sizes()
-    available_sizes = [s for s in sizes if s.name == kw['size']]
+    image_id, size_id, refreshed = lookup_catalog(driver, kw['image_name'], kw['size'])
 
-    if not available_sizes:
+    if not size_id:
         logger.error("provider does not have a matching 'size' for %s", kw['size'])
         logger.error(
             "no vm will be created. Ensure that '%s' is an available size and that it exists",
@@ -83,12 +327,7 @@ def create_node(**kw):
         )
         return
 
-    storage = kw.get("storage")
-
-    size = available_sizes[0]
-    matching_images = [i for i in images if i.name == kw['image_name']]
-
-    if not matching_images:
+    if not image_id:
         logger.error("provider does not have a matching 'image_name' for %s", kw['image_name'])
         logger.error(
             "no vm will be created. Ensure that '%s' is an available image and that it exists",
@@ -96,13 +335,22 @@ def create_node(**kw):
         )
         return
 
-    image = matching_images[0]
-
     try:
-        new_node = driver.create_node(
-            name=name, image=image, size=size,
-            ex_userdata=kw['script'], ex_keyname=kw['keyname']
-        )
+        try:
+            new_node = _create_server(driver, name, image_id, size_id, kw)
+        except BaseHTTPError as error:
+            # a cached ID that the API rejects means the image or size went
+            # away, so fetch the catalog again and retry with the new IDs
+            if refreshed or error.code not in (400, 404):
+                raise
+            logger.warning('cached image or size was rejected, refreshing catalog: %s', error)
+            image_id, size_id, refreshed = lookup_catalog(
+                driver, kw['image_name'], kw['size'], refresh=True
+            )
+            if not image_id or not size_id:
+                logger.error('image or size no longer available: %s', str(kw))
+                return
+            new_node = _create_server(driver, name, image_id, size_id, kw)
     except SSLError:
         new_node = None
         logger.error("failed to connect to provider, probably a timeout was reached")
@@ -112,66 +360,164 @@ def create_node(**kw):
         return
 
     logger.info("created node: %s", new_node)
+    return new_node
+
+
+def _create_server(driver, name, image_id, size_id, kw):
+    # only the IDs of the image and size are sent to the API, so there is no
+    # need to keep the complete objects that the listing returns
+    image = NodeImage(image_id, kw['image_name'], driver)
+    size = NodeSize(size_id, kw['size'], None, None, None, None, driver)
+    return driver.create_node(
+        name=name, image=image, size=size,
+        ex_userdata=kw['script'], ex_keyname=kw['keyname']
+    )
+
+
+# where cloud-init keeps the ID of the server, from the metadata service
+INSTANCE_ID_PATH = '/var/lib/cloud/data/instance-id'
+
+# stands for the ID of the server in the script of nodes booted in a batch
+IDENTIFIER_PLACEHOLDER = '@MITA_IDENTIFIER@'
+
+BATCH_USER_DATA = u"""#!/bin/sh
+script=$(mktemp)
+sed "s/%(placeholder)s/$(cat %(path)s)/g" > "$script" <<'MITA_SCRIPT'
+%(script)s
+MITA_SCRIPT
+chmod +x "$script"
+exec "$script"
+"""
+
+
+def batch_user_data(script):
+    """
+    Servers booted in a batch all get the same user data, so a node can't have
+    its own UUID slapped into the script. Instead, the script is wrapped so
+    that the ID of the server is put in its place when it boots (wherever it
+    is in the script, quoted or not), and that ID becomes the mita identifier.
+    The result is encoded as UTF-8.
+    """
+    if not isinstance(script, unicode):
+        script = script.decode('utf-8')
+    user_data = BATCH_USER_DATA % {
+        'placeholder': IDENTIFIER_PLACEHOLDER,
+        'path': INSTANCE_ID_PATH,
+        'script': script.rstrip('\n') % IDENTIFIER_PLACEHOLDER,
+    }
+    return user_data.encode('utf-8')
+
+
+@timed('create')
+@reauthenticate_on_failure
+def create_nodes(count, **kw):
+    """
+    Boot ``count`` identical servers with a single API call, using the
+    ``min_count``/``max_count`` options of the servers API. Returns the IDs
+    of the new servers, which can be fewer than requested (or none at all)
+    when the provider is not able to boot them in a batch, in which case the
+    rest should be created one by one.
+    """
+    driver = get_driver()
+    image_id, size_id, refreshed = lookup_catalog(driver, kw['image_name'], kw['size'])
+    if not image_id or not size_id:
+        logger.error("provider does not have a matching 'size' or 'image_name' for %s", str(kw))
+        return []
+
+    server = {
+        'name': kw['name'],
+        'imageRef': image_id,
+        'flavorRef': size_id,
+        'key_name': kw['keyname'],
+        'user_data': base64.b64encode(batch_user_data(kw['script'])),
+        'min_count': count,
+        'max_count': count,
+        'return_reservation_id': True,
+    }
+    try:
+        response = driver.connection.request(
+            '/servers', method='POST', data={'server': server}
+        ).object
+    except BaseHTTPError as error:
+        if error.code == 401:
+            raise
+        logger.warning('unable to boot %s servers in a batch: %s', count, error)
+        return []
+
+    reservation_id = response.get('reservation_id')
+    if not reservation_id:
+        # clouds without support for multiple servers ignore the counts and
+        # boot a single one
+        logger.warning('provider does not support booting servers in a batch')
+        if not response.get('server'):
+            return []
+        invalidate_inventory()
+        return [response['server']['id']]
+
+    servers = driver.connection.request(
+        '/servers/detail', params={'reservation_id': reservation_id}
+    ).object['servers']
+    server_ids = [s['id'] for s in servers]
+    invalidate_inventory()
+    logger.info('booted %s servers in reservation %s', len(server_ids), reservation_id)
+    return server_ids
+
+
+@reauthenticate_on_failure
+def create_volume(name, size):
+    """
+    Request a new volume of ``size`` gigabytes, returning its ID. The volume
+    will not be available right away, use ``volume_is_available`` to check.
+    """
+    driver = get_driver()
+    logger.info("Creating %sgb of storage for: %s", size, name)
+    return driver.create_volume(size, name).id
+
 
-    if storage:
-        logger.info("Creating %sgb of storage for: %s", storage, name)
-        new_volume = driver.create_volume(storage, name)
-        # wait for the new volume to become available
-        logger.info("Waiting for volume %s to become available", name)
-        _wait_until_volume_available(new_volume, maybe_in_use=True)
-        # wait for the new node to become available
-        logger.info("Waiting for node %s to become available", name)
-        driver.wait_until_running([new_node])
-        logger.info(" ... available")
-        logger.info("Attaching volume %s...", name)
-        if driver.attach_volume(new_node, new_volume, '/dev/vdb') is not True:
-            raise RuntimeError("Could not attach volume %s" % name)
-        logger.info("Successfully attached volume %s", name)
-
-
-def _wait_until_volume_available(volume, maybe_in_use=False):
-    """
-    Wait until a StorageVolume's state is "available".
-    Set "maybe_in_use" to True in order to wait even when the volume is
-    currently in_use. For example, set this option if you're recycling
-    this volume from an old node that you've very recently
-    destroyed.
-
-    This is the value of driver.VOLUME_STATE_MAP from libcloud as reference::
-
-        {'attaching': 7,
-         'available': 0,
-         'backing-up': 6,
-         'creating': 3,
-         'deleting': 4,
-         'error': 1,
-         'error_deleting': 1,
-         'error_extending': 1,
-         'error_restoring': 1,
-         'in-use': 2,
-         'restoring-backup': 6}
-    """
-    ok_states = ['creating', 3]  # it's ok to wait if the volume is in this
-    tries = 0
-    if maybe_in_use:
-        ok_states.append('in_use')
-    logger.info('Volume: %s is in state: %s', volume.name, volume.state)
-    while volume.state in ok_states:
-        sleep(3)
-        volume = get_volume(volume.name)
-        tries = tries + 1
-        if tries > 10:
-            logger.info("Maximum amount of tries reached..")
-            break
-        if volume.state == 'notfound':
-            logger.error('no volume was found for: %s', volume.name)
-            break
-        logger.info(' ... %s', volume.state)
-    if volume.state not in ['available', 0]:
-        # OVH uses a non-standard state of 0 to indicate an available volume
-        logger.info('Volume %s is %s (not available)', volume.name, volume.state)
-        logger.info('The volume %s is not available, but will continue anyway...', volume.name)
-    return True
+@reauthenticate_on_failure
+def volume_is_available(volume_id):
+    """
+    Check if a volume is ready to be attached, raising a ``RuntimeError`` if
+    it ended up in an error state.
+
+    These are the states from ``driver.VOLUME_STATE_MAP`` in libcloud::
+
+        {'attaching': 'attaching',
+         'available': 'available',
+         'backing-up': 'backup',
+         'creating': 'creating',
+         'deleting': 'deleting',
+         'error': 'error',
+         'error_deleting': 'error',
+         'error_extending': 'error',
+         'error_restoring': 'error',
+         'in-use': 'in_use',
+         'restoring-backup': 'backup'}
+    """
+    volume = get_driver().ex_get_volume(volume_id)
+    logger.info('Volume: %s is in state: %s', volume_id, volume.state)
+    if volume.state == 'error':
+        raise RuntimeError('volume %s is in error state' % volume_id)
+    # OVH uses a non-standard state of 0 to indicate an available volume
+    return volume.state in ['available', 0]
+
+
+@reauthenticate_on_failure
+def node_is_running(provider_id):
+    node = get_driver().ex_get_node_details(provider_id)
+    if node is None:
+        raise CloudNodeNotFound
+    return node.state == NodeState.RUNNING
+
+
+@reauthenticate_on_failure
+def attach_volume(provider_id, volume_id):
+    driver = get_driver()
+    node = Node(provider_id, None, None, [], [], driver)
+    volume = StorageVolume(volume_id, None, None, driver)
+    if driver.attach_volume(node, volume, '/dev/vdb') is not True:
+        raise RuntimeError("Could not attach volume %s" % volume_id)
+    logger.info("Successfully attached volume %s", volume_id)
 
 
 class UnavailableVolume(object):
@@ -189,6 +535,7 @@ class UnavailableVolume(object):
         self.state = state
 
 
+@reauthenticate_on_failure
 def get_volume(name):
     """ Return libcloud.compute.base.StorageVolume """
     driver = get_driver()
@@ -199,35 +546,101 @@ def get_volume(name):
         return UnavailableVolume(name)
 
 
+@timed('destroy')
+@reauthenticate_on_failure
 def destroy_node(**kw):
     """
-    Relies on the fact that names **should be** unique. Along the chain we
-    prevent non-unique names to be used/added.
+    Destroy the server with a single API call when its ``provider_id`` is
+    known. Nodes created before IDs were recorded are looked up by name in the
+    listing of servers, which relies on the fact that names **should be**
+    unique. Along the chain we prevent non-unique names to be used/added.
+    ``refresh_on_miss=False`` trusts a listing that was just fetched when the
+    name is not in it.
+    The volume of the node is destroyed by its ``volume_id``. Without one it
+    is looked up by name, unless ``storage`` is 0 (known to have no volume).
     TODO: raise an exception if more than one node is matched to the name, that
     can be propagated back to the client.
     """
     driver = get_driver()
     name = kw['name']
-    nodes = driver.list_nodes()
-    for node in nodes:
-        if node.name == name:
-            try:
-                result = driver.destroy_node(node)
-                if not result:
-                    raise RuntimeError('API failed to destroy node: %s', name)
-                destroy_volume(name)
-                return
-            except Exception:
-                logger.exception('unable to destroy_node: %s', name)
-                raise
+    provider_id = kw.get('provider_id')
+    if provider_id:
+        node = Node(provider_id, name, None, [], [], driver)
+    else:
+        node = find_node(name, refresh_on_miss=kw.get('refresh_on_miss', True))
+    if node is None:
+        raise CloudNodeNotFound
 
-    raise CloudNodeNotFound
+    try:
+        result = driver.destroy_node(node)
+    except BaseHTTPError as error:
+        if error.code == 404:
+            invalidate_inventory(node.id)
+            raise CloudNodeNotFound
+        logger.exception('unable to destroy_node: %s', name)
+        raise
+    try:
+        if not result:
+            raise RuntimeError('API failed to destroy node: %s', name)
+        invalidate_inventory(node.id)
+        if kw.get('volume_id'):
+            destroy_volume_by_id(kw['volume_id'])
+        elif kw.get('storage') != 0:
+            # nodes from before volumes were recorded (``storage`` is None)
+            # might have one
+            destroy_volume(name)
+    except Exception:
+        logger.exception('unable to destroy_node: %s', name)
+        raise
+
+
+@reauthenticate_on_failure
+def node_status(name, provider_id=None):
+    """
+    Return the state of the server as reported by the provider, fetching it
+    by ID. Nodes without a ``provider_id`` get it from the listing of servers.
+    Raises ``CloudNodeNotFound`` when the server doesn't exist.
+    """
+    driver = get_driver()
+    if not provider_id:
+        node = find_node(name)
+        if node is None:
+            raise CloudNodeNotFound
+        provider_id = node.id
+    try:
+        node = driver.ex_get_node_details(provider_id)
+    except BaseHTTPError as error:
+        if error.code != 404:
+            raise
+        node = None
+    if node is None:
+        raise CloudNodeNotFound
+    return node.state
+
+
+@reauthenticate_on_failure
+def destroy_volume_by_id(volume_id):
+    driver = get_driver()
+    volume = StorageVolume(volume_id, None, None, driver)
+    logger.info("Destroying volume %s", volume_id)
+    try:
+        driver.destroy_volume(volume)
+    except BaseHTTPError as error:
+        if error.code != 404:
+            raise
+        logger.info("volume %s no longer exists", volume_id)
 
 
+@reauthenticate_on_failure
 def destroy_volume(name):
     driver = get_driver()
     volume = get_volume(name)
     # check to see if this is a valid volume
     if volume.state != "notfound":
         logger.info("Destroying volume %s", name)
-        driver.destroy_volume(volume)
+        try:
+            driver.destroy_volume(volume)
+        except BaseHTTPError as error:
+            if error.code != 404:
+                raise
+            logger.info("volume %s no longer exists", name)
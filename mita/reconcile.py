@@ -0,0 +1,313 @@
+"""
+Brings the nodes in the mita database, the agents in Jenkins, and the servers
+in the providers in line with each other. Each of them is read once, with a
+single bulk request, and the differences between the three turn into actions
+that are applied in batches.
+"""
+import logging
+import time
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from pecan import conf
+
+from mita import models, providers, util, metrics
+from mita.connections import jenkins_connection
+from mita.exceptions import CloudNodeNotFound
+
+logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, for the histograms of how long each phase takes
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120)
+
+# Nodes that need to be removed, for one of these reasons:
+#
+# * retire: idle in Jenkins for longer than ``util.IDLE_SECONDS``
+# * orphan: the server never joined Jenkins
+# * error: the server is in error state (with or without a row)
+# * gone: the row is for a server that no longer exists
+# * leak: a server created by mita that doesn't have a row, only when
+#   ``destroy_leaks`` is enabled
+#
+# ``node`` is the row in the database, ``server`` the server in the provider
+# and ``agent`` the name of the agent in Jenkins, any of which can be ``None``
+Action = namedtuple('Action', ['kind', 'provider', 'node', 'server', 'agent'])
+
+KINDS = ('retire', 'orphan', 'error', 'gone', 'leak')
+
+
+@contextmanager
+def phase(name, timings):
+    """
+    Record how long a phase of the run took, both in ``timings`` and in the
+    ``reconcile_<name>_seconds`` histogram.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = time.time() - start
+        metrics.histogram('reconcile_%s_seconds' % name, PHASE_BUCKETS).observe(timings[name])
+
+
+class Snapshot(object):
+    """
+    The nodes in the database, the agents in Jenkins (by name), and the
+    servers of every configured provider (as a ``(by_name, by_id)`` tuple).
+    """
+
+    def __init__(self, nodes, agents, servers):
+        self.nodes = nodes
+        self.agents = agents
+        self.servers = servers
+        self.agent_names = util.index_jenkins_names(agents)
+
+    def find_agent(self, node):
+        # same as ``util.get_jenkins_name``, without listing the agents again
+        return util.find_jenkins_name(node.identifier, self.agents, self.agent_names)
+
+    def find_server(self, node):
+        by_name, by_id = self.servers[node.provider]
+        if node.provider_id:
+            return by_id.get(node.provider_id)
+        return by_name.get(node.cloud_name)
+
+
+def take_snapshot(timings):
+    with phase('snapshot_database', timings):
+        nodes = models.Node.query.all()
+    with phase('snapshot_jenkins', timings):
+        agents = util.get_jenkins_agents(refresh=True)
+    with phase('snapshot_providers', timings):
+        servers = dict(
+            (name, providers.get(name).get_inventory(refresh=True))
+            for name in conf.provider.to_dict().keys()
+        )
+    return Snapshot(nodes, agents, servers)
+
+
+class Plan(object):
+    """
+    What needs to change: rows that became idle, rows that are working again,
+    and the nodes that need to be removed (see ``Action``).
+    """
+
+    def __init__(self):
+        self.idle = []
+        self.active = []
+        self.actions = []
+
+    def add(self, kind, provider, node=None, server=None, agent=None):
+        self.actions.append(Action(kind, provider, node, server, agent))
+
+    def counts(self):
+        counts = dict((kind, 0) for kind in KINDS)
+        for action in self.actions:
+            counts[action.kind] += 1
+        counts['idle'] = len(self.idle)
+        counts['active'] = len(self.active)
+        return counts
+
+
+def destroy_leaks():
+    """
+    Servers can only be told apart from the ones created by another mita (or
+    by hand, following the same naming) in the same tenant by their name, so
+    leaks are only destroyed when the ``destroy_leaks`` key of the
+    ``reconcile`` configuration is set.
+    """
+    return conf.get('reconcile', {}).get('destroy_leaks', False)
+
+
+def is_mita_server(name):
+    """
+    Servers are named after the configured node, followed by ``__`` and the
+    identifier. Servers booted in a batch are renamed by the provider (to
+    ``<name>-1``, ``<name>-2``, and so on) so they can only be told apart by
+    the IDs recorded in their rows, and are never taken for leaks.
+    """
+    parts = name.split('__')
+    return len(parts) == 2 and parts[0] in conf.get('nodes', {}) and bool(parts[1])
+
+
+def server_is_gone(provider, node):
+    """
+    Servers can be missing from a listing without being gone (it is not
+    paginated), so ask the provider for the one server before believing it.
+    """
+    try:
+        provider.node_status(node.cloud_name, provider_id=node.provider_id)
+    except CloudNodeNotFound:
+        return True
+    except Exception:
+        logger.exception('unable to check if server is gone: %s', node.cloud_name)
+    return False
+
+
+def diff(snapshot, now=None):
+    """
+    Compare the three sides of the snapshot and return the ``Plan`` to bring
+    them in line. Nodes in providers that are not configured are left alone.
+    """
+    now = now or datetime.utcnow()
+    plan = Plan()
+    known = defaultdict(set)
+    for node in snapshot.nodes:
+        if node.provider not in snapshot.servers:
+            continue
+        provider = providers.get(node.provider)
+        server = snapshot.find_server(node)
+        agent = snapshot.find_agent(node)
+        # it might be just taking a while to boot and join Jenkins
+        settled = util.seconds_since(node.created, now) > util.ORPHAN_SECONDS
+        if server is None:
+            if settled and server_is_gone(provider, node):
+                plan.add('gone', node.provider, node, agent=agent)
+            continue
+        known[node.provider].add(server.id)
+        if provider.in_error_state(server):
+            plan.add('error', node.provider, node, server, agent)
+        elif agent is None:
+            if settled:
+                plan.add('orphan', node.provider, node, server)
+        elif snapshot.agents[agent].get('idle'):
+            if not node.idle:
+                plan.idle.append(node)
+            elif util.seconds_since(node.idle_since, now) > util.IDLE_SECONDS:
+                plan.add('retire', node.provider, node, server, agent)
+        elif node.idle:
+            plan.active.append(node)
+
+    for provider_name, (by_name, by_id) in snapshot.servers.items():
+        provider = providers.get(provider_name)
+        for server in by_id.values():
+            if server.id in known[provider_name]:
+                continue
+            # any server in error state gets removed, like ``purge`` does
+            if provider.in_error_state(server):
+                plan.add('error', provider_name, server=server)
+            elif is_mita_server(server.name):
+                # the row is committed after the server is created
+                created = provider.server_created(server)
+                if created and util.seconds_since(created, now) > util.ORPHAN_SECONDS:
+                    if destroy_leaks():
+                        plan.add('leak', provider_name, server=server)
+                    else:
+                        logger.info('server does not have a row, leaving it alone: %s', server.name)
+    return plan
+
+
+def delete_agents(actions):
+    """
+    Remove the agents of the nodes that are going away from Jenkins. Returns
+    the actions that can go ahead, which excludes the agents that couldn't be
+    removed and the idle ones that picked up a job since they were listed.
+    """
+    conn = jenkins_connection()
+    ready = []
+    for action in actions:
+        if action.agent:
+            try:
+                if action.kind == 'retire' and not conn.get_node_info(action.agent).get('idle'):
+                    logger.warning('skipping deletion of node, no longer idle: %s', action.agent)
+                    continue
+                logger.info("[jenkins] removing node: %s", action.agent)
+                conn.delete_node(action.agent)
+            except Exception:
+                logger.exception('unable to remove node from Jenkins: %s', action.agent)
+                continue
+            util.invalidate_jenkins_agents(action.agent)
+        ready.append(action)
+    return ready
+
+
+def destroy_servers(actions):
+    """
+    Destroy the servers of the actions, concurrently through the worker pool
+    of each provider. Returns the actions whose server is gone.
+    """
+    done = []
+    batches = defaultdict(list)
+    for action in actions:
+        if action.server is None:
+            done.append(action)
+        else:
+            batches[action.provider].append(action)
+
+    for provider_name, batch in batches.items():
+        provider = providers.get(provider_name)
+
+        def destroy(action):
+            node = action.node
+            name = node.cloud_name if node else action.server.name
+            logger.info("[cloud] destroying %s node: %s", action.kind, name)
+            try:
+                provider.destroy_node(
+                    name=name,
+                    provider_id=action.server.id,
+                    volume_id=node.volume_id if node else None,
+                    # without a row the volume (if any) is looked up by the
+                    # name of the server, like ``purge`` does
+                    storage=node.storage if node else None,
+                    refresh_on_miss=False,
+                )
+            except CloudNodeNotFound:
+                logger.info("node does not exist in cloud provider: %s", name)
+            except Exception:
+                logger.exception("unable to destroy node: %s", name)
+                return False
+            return True
+
+        results = providers.get_pool(provider_name).map(destroy, batch)
+        done.extend(action for action, ok in zip(batch, results) if ok)
+    return done
+
+
+def update_rows(plan, done, now):
+    """
+    Apply the idle states and remove the rows of the nodes that are gone, in
+    a single transaction.
+    """
+    try:
+        for node in plan.idle:
+            node.idle_since = now
+        for node in plan.active:
+            node.idle_since = None
+        for action in done:
+            if action.node is not None:
+                action.node.delete()
+        models.commit()
+    except Exception:
+        logger.exception('unable to update the nodes in the database')
+        models.rollback()
+        raise
+
+
+def run(now=None):
+    """
+    Reconcile the database, Jenkins, and the providers. Returns a summary
+    with the count of every change and how long (in seconds) each phase took.
+    """
+    now = now or datetime.utcnow()
+    timings = {}
+    snapshot = take_snapshot(timings)
+    with phase('diff', timings):
+        plan = diff(snapshot, now)
+    with phase('jenkins', timings):
+        ready = delete_agents(plan.actions)
+    with phase('providers', timings):
+        done = destroy_servers(ready)
+    with phase('database', timings):
+        update_rows(plan, done, now)
+
+    summary = plan.counts()
+    summary['removed'] = len(done)
+    summary['seconds'] = timings
+    logger.info(
+        'reconciled %s nodes, %s agents, and %s servers: %s',
+        len(snapshot.nodes), len(snapshot.agents),
+        sum(len(by_id) for by_name, by_id in snapshot.servers.values()),
+        ', '.join('%s %s' % (summary[key], key) for key in KINDS + ('idle', 'active', 'removed')),
+    )
+    return summary
@@ -1,6 +1,8 @@
 from celery import shared_task
 import logging
-from mita import util, models, providers
+from pecan import conf
+from mita import util, models, providers, metrics
+from mita.exceptions import CloudNodeNotFound
 logger = logging.getLogger(__name__)
 
 
@@ -14,8 +16,69 @@ def delete_node(node_id):
 
     util.delete_provider_node(
         providers.get(node.provider),
-        node.cloud_name
+        node.cloud_name,
+        node.provider_id,
+        node.volume_id,
+        node.storage,
     )
     util.delete_jenkins_node(node.jenkins_name)
     node.delete()
     models.commit()
+
+
+@shared_task(bind=True, max_retries=None)
+def attach_storage(self, node_id):
+    """
+    Create and attach the volume for a node that was configured with
+    ``storage``. The volume is requested as soon as the server is accepted so
+    that both get ready at the same time, and every stage is recorded in
+    ``node.storage_state`` so that a retry picks up where the last run
+    stopped.
+
+    Waiting for the volume and the server is done by retrying the task with
+    an exponential backoff (with jitter, capped to 30 seconds) instead of
+    blocking a worker, until the ``storage_wait_deadline`` of the provider (in
+    seconds, 600 by default) is reached.
+    """
+    node = models.Node.get(node_id)
+    if not node:
+        logger.warning('storage could not be attached')
+        logger.warning('%s node id no longer exists', node_id)
+        return
+
+    provider = providers.get(node.provider)
+    try:
+        if node.storage_state == 'pending':
+            node.volume_id = provider.create_volume(node.cloud_name, node.storage)
+            node.storage_state = 'creating'
+            models.commit()
+        if node.storage_state == 'creating':
+            if provider.volume_is_available(node.volume_id) and \
+                    provider.node_is_running(node.provider_id):
+                logger.info("Attaching volume %s to %s", node.volume_id, node.cloud_name)
+                provider.attach_volume(node.provider_id, node.volume_id)
+                node.storage_state = 'attached'
+                metrics.histogram('storage_wait_seconds').observe(
+                    util.seconds_since(node.created))
+                metrics.histogram('storage_wait_retries', (0, 1, 2, 5, 10, 20)).observe(
+                    self.request.retries)
+                models.commit()
+                return
+    except (RuntimeError, CloudNodeNotFound):
+        # the volume is in an error state, or the node is gone, retrying will
+        # not help
+        logger.exception('unable to attach storage for node: %s', node.cloud_name)
+        node.storage_state = 'failed'
+        models.commit()
+        return
+    except Exception:
+        logger.exception('errors attaching storage for node: %s, will retry', node.cloud_name)
+        models.rollback()
+
+    deadline = conf.provider[node.provider].get('storage_wait_deadline', 600)
+    if util.seconds_since(node.created) > deadline:
+        logger.error('gave up attaching storage for node: %s', node.cloud_name)
+        node.storage_state = 'failed'
+        models.commit()
+        return
+    raise self.retry(countdown=util.backoff_delay(self.request.retries, cap=30))
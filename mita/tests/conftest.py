@@ -5,6 +5,7 @@ A py.test plugin.  Loaded and run by py.test automatically.
 import os
 from pecan.testing import load_test_app
 
+import requests
 import subprocess
 
 from copy import deepcopy
@@ -45,6 +46,18 @@ def no_jenkins_requests(monkeypatch):
     from making actual connections.
     """
     monkeypatch.setattr("jenkins.Jenkins", lambda *a: fake_jenkins())
+    # clients are shared by the process, don't reuse one from another test
+    monkeypatch.setattr("mita.connections._clients", {})
+    monkeypatch.setattr("mita.connections._sessions", {})
+
+    def no_requests(*a, **kw):
+        # like ``fake_jenkins``, Jenkins has nothing to say
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{}'
+        return response
+
+    monkeypatch.setattr("mita.connections.JenkinsSession.request", no_requests)
 
 
 @pytest.fixture(autouse=True)
@@ -54,7 +67,7 @@ def no_openstack_create_node_requests(monkeypatch):
     test uses it, then you are bound to this dictatorial patching, preventing
     from making actual connections.
     """
-    monkeypatch.setattr("mita.providers.openstack.create_node", lambda **kw: True)
+    monkeypatch.setattr("mita.providers.openstack.create_node", lambda **kw: 'fake-server-id')
 
 @pytest.fixture(autouse=True)
 def no_openstack_destroy_node_requests(monkeypatch):
@@ -66,6 +79,37 @@ def no_openstack_destroy_node_requests(monkeypatch):
     monkeypatch.setattr("mita.providers.openstack.destroy_node", lambda **kw: True)
 
 
+@pytest.fixture(autouse=True)
+def no_shared_jenkins_agents():
+    """
+    The snapshot of the Jenkins agents is shared in the process, make sure
+    every test starts without one.
+    """
+    from mita import util
+    util.invalidate_jenkins_agents()
+
+
+@pytest.fixture(autouse=True)
+def no_shared_provider_inventory():
+    """
+    The listing of the servers in a provider is shared in the process, make
+    sure every test starts without one.
+    """
+    from mita import providers
+    providers.openstack.invalidate_inventory()
+
+
+@pytest.fixture(autouse=True)
+def no_shared_metrics_dir(monkeypatch, tmpdir):
+    """
+    Metrics are saved to a directory shared by every process, keep the ones
+    from tests in a directory of their own (and only save them when a test
+    asks for it).
+    """
+    path = str(tmpdir.join('metrics'))
+    monkeypatch.setattr("mita.metrics.metrics_dir", lambda: path)
+    monkeypatch.setattr("mita.metrics.start_saver", lambda: None)
+
 
 @pytest.fixture(scope='session')
 def app(request):
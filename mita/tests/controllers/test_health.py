@@ -1,14 +1,27 @@
 from mita.controllers import health
 
 
+def report(healthy):
+    return {
+        'healthy': healthy,
+        'age': 1.5,
+        'checks': {'database_connection': {'healthy': healthy, 'error': None, 'seconds': 0.01}},
+    }
+
+
 class TestHealthController(object):
 
     def test_passes_health_check(self, session, monkeypatch):
-        monkeypatch.setattr(health.checks, "is_healthy", lambda: True)
+        monkeypatch.setattr(health.checks, "health_report", lambda: report(True))
         result = session.app.get("/health/")
-        assert result.status_int == 204
+        assert result.status_int == 200
 
     def test_fails_health_check(self, session, monkeypatch):
-        monkeypatch.setattr(health.checks, "is_healthy", lambda: False)
+        monkeypatch.setattr(health.checks, "health_report", lambda: report(False))
         result = session.app.get("/health/", expect_errors=True)
         assert result.status_int == 500
+
+    def test_reports_the_latency_of_checks(self, session, monkeypatch):
+        monkeypatch.setattr(health.checks, "health_report", lambda: report(True))
+        result = session.app.get("/health/")
+        assert result.json['checks']['database_connection']['seconds'] == 0.01
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from mita.models import Node
+
+
+class TestMetricsController(object):
+
+    def create_node(self, identifier, **kw):
+        node = Node(
+            name='wheezy', keyname='ci-key', image_name='beefy-wheezy',
+            size='3xlarge', identifier=identifier, provider='openstack', **kw
+        )
+        return node
+
+    def test_exposes_nodes_by_state(self, session):
+        self.create_node('aaaa')
+        self.create_node('bbbb').idle_since = datetime.utcnow()
+        self.create_node('cccc', storage=10)
+        session.commit()
+        result = session.app.get("/metrics/")
+        assert result.content_type == 'text/plain'
+        assert 'mita_nodes{state="active"} 1' in result.body
+        assert 'mita_nodes{state="idle"} 1' in result.body
+        assert 'mita_nodes{state="provisioning"} 1' in result.body
+        assert 'mita_nodes{state="failed"} 0' in result.body
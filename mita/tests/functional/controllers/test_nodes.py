@@ -1,7 +1,14 @@
+from collections import namedtuple
 from mita.controllers import nodes
+from mita.providers import openstack
+from mita.providers.openstack import destroy_node
 from datetime import timedelta, datetime
 from mita.models import Node
+from mita.models.nodes import label_signature
 from mita.tests.conftest import fake_jenkins
+from mock import Mock
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 
 class TestNodesController(object):
@@ -21,6 +28,122 @@ class TestNodesController(object):
         )
         assert result.status_int == 200
 
+    def test_provider_id_is_stored(self, session):
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+            }
+        )
+        node = Node.get(1)
+        assert node.provider_id == 'fake-server-id'
+
+    def test_creates_the_buffered_count(self, session):
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'count': 4,
+            }
+        )
+        assert Node.query.count() == 3
+
+    def test_failed_nodes_are_not_recorded(self, session, monkeypatch):
+        results = iter(['fake-server-id', None])
+        monkeypatch.setattr(
+            "mita.providers.openstack.create_node", lambda **kw: next(results))
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'count': 3,
+            }
+        )
+        assert Node.query.count() == 1
+
+    def test_storage_is_attached_in_the_background(self, session, monkeypatch):
+        attach_storage = Mock()
+        monkeypatch.setattr(nodes, 'attach_storage', attach_storage)
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'storage': 10,
+            }
+        )
+        node = Node.get(1)
+        assert node.storage_state == 'pending'
+        attach_storage.delay.assert_called_with(node.id)
+
+    def test_batch_boot(self, session, monkeypatch):
+        monkeypatch.setattr(
+            "mita.providers.openstack.create_nodes", lambda count, **kw: ['a', 'b'])
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'count': 4,
+                'batch_boot': True,
+            }
+        )
+        identifiers = [n.identifier for n in Node.query.all()]
+        assert 'a' in identifiers
+        assert 'b' in identifiers
+        # the rest are created one by one
+        assert len(identifiers) == 3
+
+    def test_batch_boot_without_server_ids(self, session, monkeypatch):
+        monkeypatch.setattr(
+            "mita.providers.openstack.create_nodes", lambda count, **kw: ['a', None])
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'count': 2,
+                'batch_boot': True,
+            }
+        )
+        nodes = Node.query.all()
+        assert all(n.provider_id for n in nodes)
+        # the one without an ID is created again, one by one
+        assert len(nodes) == 2
+
     def test_idle_is_unset(self, session):
         session.app.post_json(
             '/api/nodes/',
@@ -77,8 +200,116 @@ class TestNodesController(object):
         assert node.idle_since is None
 
 
+class TestMatchingNodes(object):
+
+    params = {
+        'name': 'wheezy',
+        'provider': 'openstack',
+        'keyname': 'ci-key',
+        'image_name': 'beefy-wheezy',
+        'size': '3xlarge',
+        'script': '#!/bin/bash echo hello world! %s',
+        'labels': ['wheezy', 'amd64'],
+    }
+
+    def create_node(self, identifier, labels):
+        return Node(
+            name='wheezy',
+            keyname='ci-key',
+            image_name='beefy-wheezy',
+            size='3xlarge',
+            identifier=identifier,
+            provider='openstack',
+            labels=labels,
+        )
+
+    def test_matches_labels_with_a_single_query(self, session, monkeypatch):
+        for i in range(5):
+            self.create_node('node-%s' % i, ['wheezy', 'amd64'])
+        session.commit()
+        statements = []
+
+        def count(conn, cursor, statement, *a):
+            statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            session.app.post_json('/api/nodes/', params=self.params)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        selects = [s for s in statements if s.strip().startswith('SELECT')]
+        assert len(selects) == 1
+        # the recently created nodes were enough, nothing got created
+        assert Node.query.count() == 5
+
+    def test_node_created_a_day_ago_is_not_recent(self, session):
+        node = self.create_node('node-1', ['wheezy', 'amd64'])
+        node.created = datetime.utcnow() - timedelta(days=1, seconds=60)
+        session.commit()
+        session.app.post_json('/api/nodes/', params=self.params)
+        assert Node.query.count() == 2
+
+    def test_counts_nodes_by_type(self, session):
+        self.create_node('node-1', ['wheezy', 'amd64'])
+        old = self.create_node('node-2', ['wheezy', 'amd64'])
+        old.created = datetime.utcnow() - timedelta(seconds=600)
+        self.create_node('node-3', ['wheezy'])
+        session.commit()
+        cutoff = datetime.utcnow() - timedelta(seconds=360)
+        counts = Node.count_by_type(cutoff, name='wheezy')
+        assert counts[('wheezy', label_signature(['wheezy', 'amd64']))] == (2, 1)
+        assert counts[('wheezy', label_signature(['wheezy']))] == (1, 1)
+
+    def test_node_with_other_labels_does_not_match(self, session):
+        self.create_node('node-1', ['wheezy', 'amd64', 'huge'])
+        session.commit()
+        session.app.post_json('/api/nodes/', params=self.params)
+        assert Node.query.count() == 2
+
+    def test_node_with_some_of_the_labels_does_not_match(self, session):
+        self.create_node('node-1', ['wheezy'])
+        session.commit()
+        session.app.post_json('/api/nodes/', params=self.params)
+        assert Node.query.count() == 2
+
+    def test_labels_in_any_order_match(self, session):
+        self.create_node('node-1', ['amd64', 'wheezy', 'amd64'])
+        session.commit()
+        session.app.post_json('/api/nodes/', params=self.params)
+        assert Node.query.count() == 1
+
+
 class TestNodeDeletion(object):
 
+    def test_batch_booted_node_gets_destroyed(self, session, monkeypatch):
+        monkeypatch.setattr(
+            "mita.providers.openstack.create_nodes", lambda count, **kw: ['a', 'b'])
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy-slave',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+                'count': 2,
+                'batch_boot': True,
+            }
+        )
+        # the servers were renamed by the provider, only their ID can find them
+        driver = Mock()
+        driver.list_nodes.return_value = [
+            namedtuple('Server', ['id', 'name'])('a', 'wheezy-slave-1'),
+        ]
+        monkeypatch.setattr(openstack, 'get_driver', lambda: driver)
+        monkeypatch.setattr(openstack, 'destroy_node', destroy_node)
+        session.app.post_json('/api/nodes/a/delete/', params={})
+        assert driver.destroy_node.call_args[0][0].id == 'a'
+        assert not driver.list_volumes.called
+        assert [n.identifier for n in Node.query.all()] == ['b']
+
     def test_make_node_active(self, session):
         session.app.post_json(
             '/api/nodes/',
@@ -175,3 +406,57 @@ class TestNodeDeletion(object):
         session.commit()
         session.app.post('/api/nodes/%s/idle/' % node.identifier)
         assert Node.get(1) is None
+
+
+class TestNodeStates(object):
+
+    def create_node(self, session, idle_since=None):
+        session.app.post_json(
+            '/api/nodes/',
+            params={
+                'name': 'wheezy-slave',
+                'provider': 'openstack',
+                'keyname': 'ci-key',
+                'image_name': 'beefy-wheezy',
+                'size': '3xlarge',
+                'script': '#!/bin/bash echo hello world! %s',
+                'labels': ['wheezy', 'amd64'],
+            }
+        )
+        node = Node.query.order_by(Node.id.desc()).first()
+        node.idle_since = idle_since
+        session.commit()
+        return Node.query.order_by(Node.id.desc()).first().identifier
+
+    def test_updates_many_nodes(self, session):
+        idle = self.create_node(session)
+        # a recently created node would prevent creating another one
+        Node.query.update({'created': datetime.utcnow() - timedelta(seconds=600)})
+        session.commit()
+        active = self.create_node(session, idle_since=datetime.utcnow())
+        result = session.app.post_json(
+            '/api/nodes/states/',
+            params=[
+                {'identifier': idle, 'state': 'idle'},
+                {'identifier': active, 'state': 'active'},
+                {'identifier': 'unknown', 'state': 'idle'},
+                {'identifier': idle, 'state': 'sleeping'},
+            ]
+        )
+        assert [r['result'] for r in result.json['nodes']] == [
+            'idle', 'active', 'not found', 'invalid'
+        ]
+        assert Node.filter_by(identifier=idle).first().idle_since is not None
+        assert Node.filter_by(identifier=active).first().idle_since is None
+
+    def test_requires_a_list(self, session):
+        result = session.app.post_json(
+            '/api/nodes/states/',
+            params={'identifier': 'aaaa', 'state': 'idle'},
+            expect_errors=True
+        )
+        assert result.status_int == 400
+
+    def test_requires_post(self, session):
+        result = session.app.get('/api/nodes/states/', expect_errors=True)
+        assert result.status_int == 405
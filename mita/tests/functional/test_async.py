@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+import importlib
+
+from mock import Mock
+
+from mita import util, connections, metrics, providers
+from mita.models import Node
+
+# ``async`` is a reserved word in newer Pythons, import it by name
+async_tasks = importlib.import_module('mita.async')
+
+
+def create_node(identifier, idle_since=None):
+    node = Node(
+        name='wheezy',
+        keyname='ci-key',
+        image_name='beefy-wheezy',
+        size='3xlarge',
+        identifier=identifier,
+        provider='openstack',
+    )
+    node.idle_since = idle_since
+    return node
+
+
+class TestCheckIdling(object):
+
+    def jenkins_nodes(self, monkeypatch, *nodes):
+        monkeypatch.setattr(
+            util, 'get_jenkins_nodes',
+            lambda: [
+                {'name': 'wheezy__%s' % i, 'idle': idle, 'labels': []}
+                for i, idle in nodes
+            ]
+        )
+
+    def test_updates_states_without_calling_the_api(self, session, monkeypatch):
+        create_node('aaaa')
+        create_node('bbbb', idle_since=datetime.utcnow())
+        session.commit()
+        self.jenkins_nodes(monkeypatch, ('aaaa', True), ('bbbb', False))
+        summary = async_tasks.check_idling()
+        assert Node.filter_by(identifier='aaaa').first().idle_since is not None
+        assert Node.filter_by(identifier='bbbb').first().idle_since is None
+        assert summary['idle'] == 1
+        assert summary['active'] == 1
+
+    def test_unknown_and_unchanged_nodes_are_counted(self, session, monkeypatch):
+        create_node('aaaa', idle_since=datetime.utcnow())
+        session.commit()
+        self.jenkins_nodes(monkeypatch, ('aaaa', True), ('cccc', True))
+        summary = async_tasks.check_idling()
+        assert summary['unchanged'] == 1
+        assert summary['unknown'] == 1
+
+    def test_long_idle_nodes_get_destroyed(self, session, monkeypatch):
+        create_node('aaaa', idle_since=datetime.utcnow() - timedelta(days=1, seconds=10))
+        session.commit()
+        self.jenkins_nodes(monkeypatch, ('aaaa', True))
+        summary = async_tasks.check_idling()
+        assert summary['destroyed'] == 1
+        assert Node.query.count() == 0
+
+    def test_a_failing_node_does_not_bring_back_the_others(self, session, monkeypatch):
+        long_ago = datetime.utcnow() - timedelta(days=1, seconds=10)
+        create_node('aaaa', idle_since=long_ago)
+        create_node('bbbb', idle_since=long_ago)
+        create_node('cccc')
+        session.commit()
+        self.jenkins_nodes(monkeypatch, ('aaaa', True), ('bbbb', True), ('cccc', True))
+
+        def destroy_node(**kw):
+            if kw['name'].endswith('bbbb'):
+                raise RuntimeError('API failed to destroy node')
+
+        monkeypatch.setattr(providers.openstack, 'destroy_node', destroy_node)
+        summary = async_tasks.check_idling()
+        assert summary['destroyed'] == 1
+        assert summary['failed'] == 1
+        assert summary['idle'] == 1
+        session.rollback()
+        assert sorted(n.identifier for n in Node.query.all()) == ['bbbb', 'cccc']
+        assert Node.filter_by(identifier='cccc').first().idle_since is not None
+
+
+class TestCheckQueueMetrics(object):
+
+    def test_counts_stuck_items_by_node_type(self, session, monkeypatch):
+        conn = Mock()
+        conn.get_queue_info.return_value = [
+            {'why': u'There are no nodes with the label \u2018centos7\u2019',
+             'task': {'name': 'ceph-build', 'url': 'http://jenkins.example.com/job/ceph-build/'}},
+        ]
+        monkeypatch.setattr(connections, 'jenkins_connection', lambda: conn)
+        monkeypatch.setattr(util, 'match_reason', lambda reason: 'centos7-slave')
+        monkeypatch.setattr(async_tasks.requests, 'post', lambda *a, **kw: None)
+        async_tasks.check_queue()
+        assert metrics.gauge('stuck_queue_items', node='centos7-slave').value == 1
+        assert metrics.gauge('stuck_queue_items', node='wheezy-slave').value == 0
+
+
+class TestTaskMetrics(object):
+
+    def test_task_runtime_is_recorded(self):
+        task = Mock()
+        task.name = 'async.check_idling'
+        histogram = metrics.histogram(
+            'celery_task_seconds', metrics.LATENCY_BUCKETS, task='async.check_idling')
+        count = histogram.count
+        async_tasks.start_task_timer(task_id='1234')
+        async_tasks.record_task_runtime(task_id='1234', task=task)
+        assert histogram.count == count + 1
+
+
+class TestCheckOrphaned(object):
+
+    def test_nodes_created_days_ago_are_orphans(self, session, monkeypatch):
+        node = create_node('aaaa')
+        node.created = datetime.utcnow() - timedelta(days=1, minutes=5)
+        session.commit()
+        monkeypatch.setattr(util, 'get_jenkins_nodes', lambda: [])
+        destroyed = []
+        monkeypatch.setattr(
+            async_tasks.providers.openstack, 'destroy_node',
+            lambda **kw: destroyed.append(kw['name']))
+        monkeypatch.setattr(async_tasks.providers.openstack, 'refresh_inventory', lambda: None)
+        monkeypatch.setattr(async_tasks.providers.openstack, 'purge', lambda: None)
+        async_tasks.check_orphaned()
+        assert destroyed == ['wheezy__aaaa']
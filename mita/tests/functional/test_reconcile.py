@@ -0,0 +1,236 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from mock import Mock
+
+from mita import util, reconcile, metrics, providers
+from mita.exceptions import CloudNodeNotFound
+from mita.models import Node
+
+Server = namedtuple('Server', ['id', 'name', 'state', 'extra'])
+
+long_ago = datetime.utcnow() - timedelta(days=1)
+
+
+def create_node(identifier, created=long_ago, idle_since=None):
+    node = Node(
+        name='wheezy-slave',
+        keyname='ci-key',
+        image_name='beefy-wheezy',
+        size='3xlarge',
+        identifier=identifier,
+        provider='openstack',
+        provider_id='id-%s' % identifier,
+    )
+    node.created = created
+    node.idle_since = idle_since
+    return node
+
+
+def server(identifier, state=0, created=long_ago, name=None):
+    return Server(
+        'id-%s' % identifier,
+        name or 'wheezy-slave__%s' % identifier,
+        state,
+        {'created': created.strftime('%Y-%m-%dT%H:%M:%SZ')},
+    )
+
+
+class TestReconcile(object):
+
+    def setup(self):
+        self.destroyed = []
+        self.destroy_calls = []
+        self.conn = Mock()
+        self.conn.get_node_info.return_value = {'idle': True}
+        # servers missing from the listing that do exist, by ID
+        self.unlisted = {}
+
+    def node_status(self, name, provider_id=None):
+        if provider_id not in self.unlisted:
+            raise CloudNodeNotFound
+        return self.unlisted[provider_id]
+
+    def destroy_node(self, **kw):
+        self.destroy_calls.append(kw)
+        self.destroyed.append(kw['provider_id'])
+
+    def snapshot(self, monkeypatch, agents=(), servers=()):
+        monkeypatch.setattr(
+            util, 'get_jenkins_nodes',
+            lambda: [
+                {'name': 'wheezy__%s' % i, 'idle': idle, 'labels': []}
+                for i, idle in agents
+            ]
+        )
+        by_id = dict((s.id, s) for s in servers)
+        by_name = dict((s.name, s) for s in servers)
+        monkeypatch.setattr(
+            providers.openstack, 'get_inventory', lambda refresh=False: (by_name, by_id))
+        monkeypatch.setattr(
+            providers.openstack, 'destroy_node',
+            self.destroy_node)
+        monkeypatch.setattr(providers.openstack, 'node_status', self.node_status)
+        monkeypatch.setattr(reconcile, 'jenkins_connection', lambda: self.conn)
+
+    def test_nodes_in_line_are_left_alone(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(monkeypatch, agents=[('aaaa', False)], servers=[server('aaaa')])
+        summary = reconcile.run()
+        assert summary['removed'] == 0
+        assert Node.query.count() == 1
+
+    def test_marks_idle_and_active_nodes(self, session, monkeypatch):
+        create_node('aaaa')
+        create_node('bbbb', idle_since=datetime.utcnow())
+        session.commit()
+        self.snapshot(
+            monkeypatch,
+            agents=[('aaaa', True), ('bbbb', False)],
+            servers=[server('aaaa'), server('bbbb')])
+        summary = reconcile.run()
+        assert Node.filter_by(identifier='aaaa').first().idle_since is not None
+        assert Node.filter_by(identifier='bbbb').first().idle_since is None
+        assert summary['idle'] == summary['active'] == 1
+
+    def test_retires_long_idle_nodes(self, session, monkeypatch):
+        create_node('aaaa', idle_since=long_ago)
+        session.commit()
+        self.snapshot(monkeypatch, agents=[('aaaa', True)], servers=[server('aaaa')])
+        summary = reconcile.run()
+        assert summary['retire'] == 1
+        assert self.conn.delete_node.call_args[0][0] == 'wheezy__aaaa'
+        assert self.destroyed == ['id-aaaa']
+        assert Node.query.count() == 0
+
+    def test_does_not_retire_nodes_that_got_busy(self, session, monkeypatch):
+        create_node('aaaa', idle_since=long_ago)
+        session.commit()
+        self.snapshot(monkeypatch, agents=[('aaaa', True)], servers=[server('aaaa')])
+        self.conn.get_node_info.return_value = {'idle': False}
+        summary = reconcile.run()
+        assert summary['removed'] == 0
+        assert self.destroyed == []
+        assert Node.query.count() == 1
+
+    def test_destroys_orphans(self, session, monkeypatch):
+        create_node('aaaa')
+        create_node('bbbb', created=datetime.utcnow())
+        session.commit()
+        self.snapshot(monkeypatch, servers=[server('aaaa'), server('bbbb')])
+        summary = reconcile.run()
+        assert summary['orphan'] == 1
+        assert self.destroyed == ['id-aaaa']
+        assert [n.identifier for n in Node.query.all()] == ['bbbb']
+
+    def test_agents_without_the_naming_convention_are_found(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(monkeypatch, servers=[server('aaaa')])
+        monkeypatch.setattr(
+            util, 'get_jenkins_nodes',
+            lambda: [{'name': 'wheezy-aaaa', 'idle': False, 'labels': []}])
+        summary = reconcile.run()
+        assert summary['orphan'] == 0
+        assert self.destroyed == []
+        assert Node.query.count() == 1
+
+    def test_removes_rows_of_servers_that_are_gone(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(monkeypatch, agents=[('aaaa', True)])
+        summary = reconcile.run()
+        assert summary['gone'] == 1
+        assert self.destroyed == []
+        assert self.conn.delete_node.call_args[0][0] == 'wheezy__aaaa'
+        assert Node.query.count() == 0
+
+    def test_keeps_rows_of_servers_missing_from_the_listing(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(monkeypatch, agents=[('aaaa', True)])
+        self.unlisted['id-aaaa'] = 0
+        summary = reconcile.run()
+        assert summary['gone'] == 0
+        assert not self.conn.delete_node.called
+        assert Node.query.count() == 1
+
+    def test_destroys_servers_in_error_state(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(
+            monkeypatch,
+            agents=[('aaaa', False)],
+            servers=[server('aaaa', state='error'), server('zzzz', state=7, name='other')])
+        summary = reconcile.run()
+        assert summary['error'] == 2
+        assert sorted(self.destroyed) == ['id-aaaa', 'id-zzzz']
+        assert Node.query.count() == 0
+
+    def test_leaked_servers_are_left_alone_by_default(self, session, monkeypatch):
+        self.snapshot(monkeypatch, servers=[server('aaaa')])
+        summary = reconcile.run()
+        assert summary['leak'] == 0
+        assert self.destroyed == []
+
+    def test_destroys_leaked_servers(self, session, monkeypatch):
+        monkeypatch.setattr(reconcile, 'destroy_leaks', lambda: True)
+        self.snapshot(monkeypatch, servers=[
+            server('aaaa'),
+            server('bbbb', created=datetime.utcnow()),
+            server('cccc', name='not-from-mita'),
+        ])
+        summary = reconcile.run()
+        assert summary['leak'] == 1
+        assert self.destroyed == ['id-aaaa']
+        # the volume is looked up by the name of the server
+        assert self.destroy_calls[0]['name'] == 'wheezy-slave__aaaa'
+        assert self.destroy_calls[0]['storage'] is None
+
+    def test_does_not_guess_leaks_from_batch_names(self, session, monkeypatch):
+        monkeypatch.setattr(reconcile, 'destroy_leaks', lambda: True)
+        self.snapshot(monkeypatch, servers=[
+            server('aaaa', name='wheezy-slave'),
+            server('bbbb', name='wheezy-slave-1'),
+            server('cccc', name='wheezy-slave__cccc__extra'),
+        ])
+        summary = reconcile.run()
+        assert summary['leak'] == 0
+        assert self.destroyed == []
+
+    def test_batch_servers_are_known_by_their_id(self, session, monkeypatch):
+        node = create_node('id-aaaa')
+        node.provider_id = 'id-aaaa'
+        session.commit()
+        self.snapshot(
+            monkeypatch,
+            agents=[('id-aaaa', False)],
+            servers=[server('aaaa', name='wheezy-slave-2')])
+        summary = reconcile.run()
+        assert summary['removed'] == 0
+        assert Node.query.count() == 1
+
+    def test_keeps_rows_when_the_server_is_not_destroyed(self, session, monkeypatch):
+        create_node('aaaa')
+        session.commit()
+        self.snapshot(monkeypatch, servers=[server('aaaa')])
+
+        def fail(**kw):
+            raise RuntimeError('API failed to destroy node')
+
+        monkeypatch.setattr(providers.openstack, 'destroy_node', fail)
+        summary = reconcile.run()
+        assert summary['orphan'] == 1
+        assert summary['removed'] == 0
+        assert Node.query.count() == 1
+
+    def test_records_how_long_each_phase_took(self, session, monkeypatch):
+        self.snapshot(monkeypatch)
+        count = metrics.histogram('reconcile_diff_seconds').count
+        summary = reconcile.run()
+        assert sorted(summary['seconds']) == [
+            'database', 'diff', 'jenkins', 'providers',
+            'snapshot_database', 'snapshot_jenkins', 'snapshot_providers',
+        ]
+        assert metrics.histogram('reconcile_diff_seconds').count == count + 1
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from mock import Mock
+from celery.exceptions import Retry
+import pytest
+
+from mita import tasks, metrics
+from mita.models import Node
+
+
+class TestAttachStorage(object):
+
+    def setup(self):
+        self.provider = Mock()
+        self.provider.create_volume.return_value = 'volume-id'
+
+    def create_node(self, session):
+        node = Node(
+            name='wheezy',
+            keyname='ci-key',
+            image_name='beefy-wheezy',
+            size='3xlarge',
+            identifier='aaaa',
+            provider='openstack',
+            provider_id='server-id',
+            storage=10,
+        )
+        session.commit()
+        return Node.get(1)
+
+    def test_attaches_when_ready(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        self.create_node(session)
+        tasks.attach_storage(1)
+        node = Node.get(1)
+        assert node.volume_id == 'volume-id'
+        assert node.storage_state == 'attached'
+        self.provider.attach_volume.assert_called_with('server-id', 'volume-id')
+
+    def test_retries_while_not_ready(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        self.provider.node_is_running.return_value = False
+        self.create_node(session)
+        with pytest.raises(Retry):
+            tasks.attach_storage(1)
+        node = Node.get(1)
+        assert node.storage_state == 'creating'
+        assert not self.provider.attach_volume.called
+
+    def test_resumes_without_creating_another_volume(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        node = self.create_node(session)
+        node.volume_id = 'volume-id'
+        node.storage_state = 'creating'
+        session.commit()
+        tasks.attach_storage(1)
+        assert not self.provider.create_volume.called
+        assert Node.get(1).storage_state == 'attached'
+
+    def test_volume_in_error_fails(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        self.provider.volume_is_available.side_effect = RuntimeError('volume in error state')
+        self.create_node(session)
+        tasks.attach_storage(1)
+        assert Node.get(1).storage_state == 'failed'
+
+    def test_gives_up_after_the_deadline(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        self.provider.volume_is_available.return_value = False
+        node = self.create_node(session)
+        node.created = datetime.utcnow() - timedelta(seconds=601)
+        session.commit()
+        tasks.attach_storage(1)
+        assert Node.get(1).storage_state == 'failed'
+
+    def test_wait_time_is_recorded(self, session, monkeypatch):
+        monkeypatch.setattr(tasks.providers, 'get', lambda name: self.provider)
+        wait_seconds = metrics.histogram('storage_wait_seconds')
+        wait_seconds.reset()
+        self.create_node(session)
+        tasks.attach_storage(1)
+        assert wait_seconds.count == 1
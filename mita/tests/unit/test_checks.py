@@ -0,0 +1,86 @@
+import time
+from collections import namedtuple
+
+import pytest
+from pecan import set_config
+
+from mita import checks
+
+StatVFS = namedtuple('StatVFS', ['f_blocks', 'f_bfree', 'f_bavail'])
+
+
+class TestDiskHasSpace(object):
+
+    def setup(self):
+        set_config({'repo_path': '/srv/repos'}, overwrite=True)
+
+    def test_disk_with_space(self):
+        checks.disk_has_space(_statvfs=lambda path: StatVFS(100, 50, 45))
+
+    def test_disk_almost_full(self):
+        with pytest.raises(checks.SystemCheckError) as error:
+            checks.disk_has_space(_statvfs=lambda path: StatVFS(100, 10, 5))
+        assert error.value.message == 'disk /srv/repos almost full. Used: 95%'
+
+    def test_reserved_blocks_are_not_available(self):
+        # 81 used, 5 reserved for root and 14 available is more than 85% used
+        with pytest.raises(checks.SystemCheckError):
+            checks.disk_has_space(_statvfs=lambda path: StatVFS(100, 19, 14))
+
+    def test_disk_can_not_be_checked(self):
+        def statvfs(path):
+            raise OSError(2, 'No such file or directory')
+
+        with pytest.raises(checks.SystemCheckError):
+            checks.disk_has_space(_statvfs=statvfs)
+
+
+class TestHealthReport(object):
+
+    def setup(self):
+        set_config({'health': {'max_age': 60}}, overwrite=True)
+
+    def check(self, name, error=None):
+        def check():
+            if error:
+                raise checks.SystemCheckError(error)
+        check.__name__ = name
+        return check
+
+    @pytest.fixture(autouse=True)
+    def no_sampler(self, monkeypatch):
+        monkeypatch.setattr(checks, 'start_sampler', lambda: None)
+        monkeypatch.setattr(checks, '_sample', (None, {}))
+
+    def test_no_results_yet(self, monkeypatch):
+        monkeypatch.setattr(checks, 'system_checks', (self.check('database'),))
+        report = checks.health_report()
+        assert report['healthy'] is True
+        assert 'database' in report['checks']
+
+    def test_all_checks_pass(self, monkeypatch):
+        monkeypatch.setattr(checks, 'system_checks', (self.check('database'),))
+        checks.run_checks()
+        report = checks.health_report()
+        assert report['healthy'] is True
+        assert report['checks']['database']['seconds'] >= 0
+
+    def test_a_check_fails(self, monkeypatch):
+        monkeypatch.setattr(checks, 'system_checks', (self.check('database'), self.check('disk', 'broken')))
+        checks.run_checks()
+        report = checks.health_report()
+        assert report['healthy'] is False
+        assert report['checks']['disk']['error'] == 'broken'
+
+    def test_stale_results(self, monkeypatch):
+        monkeypatch.setattr(checks, 'system_checks', (self.check('database'),))
+        checks.run_checks()
+        monkeypatch.setattr(checks.time, 'time', lambda: 2 ** 40)
+        assert checks.health_report()['healthy'] is False
+
+    def test_probe_does_not_run_the_checks(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(checks, 'system_checks', (lambda: calls.append(1),))
+        monkeypatch.setattr(checks, '_sample', (time.time(), {}))
+        checks.health_report()
+        assert calls == []
@@ -0,0 +1,62 @@
+import requests
+from pecan import set_config
+from requests.adapters import HTTPAdapter
+
+from mita import connections
+
+
+class TestJenkinsEndpoint(object):
+
+    def test_groups_agent_names(self):
+        url = 'http://jenkins.example.com/computer/centos7__2f3a/config.xml'
+        assert connections.jenkins_endpoint(url) == '/computer/*/config.xml'
+
+    def test_groups_job_names(self):
+        url = 'http://jenkins.example.com/job/ceph-pull-requests/api/json'
+        assert connections.jenkins_endpoint(url) == '/job/*/api/json'
+
+    def test_keeps_listings(self):
+        url = 'http://jenkins.example.com/computer/api/json?tree=computer[idle]'
+        assert connections.jenkins_endpoint(url) == '/computer/api/json'
+
+
+class TestJenkinsConnection(object):
+
+    def setup(self):
+        set_config(
+            {'jenkins': {
+                'url': 'http://jenkins.example.com',
+                'user': 'alfredo',
+                'token': 'secret'}},
+            overwrite=True
+        )
+
+    def test_client_is_reused(self):
+        assert connections.jenkins_connection() is connections.jenkins_connection()
+
+    def test_new_client_when_config_changes(self):
+        client = connections.jenkins_connection()
+        set_config({'jenkins': {'token': 'other'}}, overwrite=False)
+        assert connections.jenkins_connection() is not client
+
+    def test_session_is_reused(self):
+        assert connections.jenkins_session() is connections.jenkins_session()
+
+    def test_session_uses_configured_timeout(self):
+        set_config({'jenkins': {'timeout': 5}}, overwrite=False)
+        assert connections.jenkins_session().timeout == 5
+
+    def test_session_pools_connections(self):
+        set_config({'jenkins': {'pool_size': 3}}, overwrite=False)
+        adapter = connections.jenkins_session().get_adapter('http://jenkins.example.com')
+        assert isinstance(adapter, connections.CountingAdapter)
+        assert adapter._pool_maxsize == 3
+
+    def test_requests_are_counted(self, monkeypatch):
+        monkeypatch.setattr(HTTPAdapter, 'send', lambda self, request, **kw: None)
+        before = connections.jenkins_request_counts().get('/queue/api/json', 0)
+        adapter = connections.CountingAdapter()
+        request = requests.Request('GET', 'http://jenkins.example.com/queue/api/json')
+        adapter.send(request.prepare())
+        after = connections.jenkins_request_counts()['/queue/api/json']
+        assert after == before + 1
@@ -1,8 +1,12 @@
 import pytest
+from mita import label_eval
 from mita.label_eval import (
     pythonize_boolean,
     validate_and_parse,
-    matching_nodes
+    matching_nodes,
+    compile_expr,
+    node_bitsets,
+    NodeBitsets,
 )
 
 boolean_exprs = [
@@ -67,3 +71,49 @@ class TestLabelMatch(object):
     @pytest.mark.parametrize('expr,matches', match_exprs)
     def test_matching_nodes(self, expr, matches):
         assert sorted(matching_nodes(expr, nodes)) == sorted(matches)
+
+
+class TestCompileExpr(object):
+
+    def setup(self):
+        label_eval._matchers.clear()
+
+    def test_compiled_expression_is_cached(self):
+        assert compile_expr('huge&&amd64') is compile_expr('huge&&amd64')
+
+    @pytest.mark.parametrize('expr', invalid_exprs)
+    def test_invalid_expressions_do_not_compile(self, expr):
+        assert compile_expr(expr) is None
+
+    def test_cache_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(label_eval, '_matchers', label_eval.LRUCache(2))
+        first = compile_expr('a')
+        compile_expr('b')
+        compile_expr('c')
+        assert 'a' not in label_eval._matchers
+        assert compile_expr('a') is not first
+
+    def test_least_recently_used_is_evicted(self, monkeypatch):
+        monkeypatch.setattr(label_eval, '_matchers', label_eval.LRUCache(2))
+        compile_expr('a')
+        compile_expr('b')
+        compile_expr('a')
+        compile_expr('c')
+        assert 'a' in label_eval._matchers
+        assert 'b' not in label_eval._matchers
+
+
+class TestNodeBitsets(object):
+
+    def test_labels_map_to_node_bits(self):
+        bitsets = NodeBitsets(nodes)
+        assert bitsets.nodes_in(bitsets.masks['amd64']) == bitsets.names
+        assert bitsets.nodes_in(bitsets.masks['huge']) == ['wheezy_huge']
+
+    def test_negation_only_includes_configured_nodes(self):
+        bitsets = NodeBitsets(nodes)
+        mask = compile_expr('!arm64').match(bitsets)
+        assert sorted(bitsets.nodes_in(mask)) == sorted(nodes.keys())
+
+    def test_bitsets_are_reused_for_the_same_nodes(self):
+        assert node_bitsets(nodes) is node_bitsets(nodes)
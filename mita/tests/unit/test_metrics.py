@@ -0,0 +1,173 @@
+import json
+import os
+import subprocess
+import time
+
+from mita import metrics
+
+
+class TestHistogram(object):
+
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('wait', buckets=(1, 10))
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert histogram.as_dict()['buckets'] == {1: 1, 10: 2}
+
+    def test_counts_and_sums(self):
+        histogram = metrics.Histogram('wait', buckets=(1, 10))
+        histogram.observe(2)
+        histogram.observe(20)
+        assert histogram.count == 2
+        assert histogram.sum == 22
+
+    def test_registry_returns_the_same_histogram(self):
+        assert metrics.histogram('test_wait') is metrics.histogram('test_wait')
+
+    def test_registry_keeps_histograms_by_labels(self):
+        first = metrics.histogram('test_latency', endpoint='/queue')
+        assert first is not metrics.histogram('test_latency', endpoint='/computer')
+        assert first in metrics.family('test_latency')
+
+
+class TestTimer(object):
+
+    def test_observes_how_long_it_took(self):
+        with metrics.timer('test_timer', operation='list'):
+            pass
+        assert metrics.histogram('test_timer', operation='list').count == 1
+
+    def test_observes_errors_too(self):
+        @metrics.timed('test_timed', operation='destroy')
+        def fail():
+            raise RuntimeError()
+
+        try:
+            fail()
+        except RuntimeError:
+            pass
+        assert metrics.histogram('test_timed', operation='destroy').count == 1
+
+
+class TestCollect(object):
+
+    def saved_by_other_process(self, records, saved, name='1.json'):
+        path = metrics.metrics_dir()
+        metrics.save()
+        other = os.path.join(path, name)
+        with open(other, 'w') as f:
+            json.dump({'saved': saved, 'metrics': records}, f)
+        return other
+
+    def dead_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def find(self, records, name, **labels):
+        for record in records:
+            if record['name'] == name and record['labels'] == labels:
+                return record
+
+    def test_adds_up_histograms_and_counters(self):
+        metrics.histogram('test_collect', (1, 10)).observe(2)
+        metrics.counter('test_collect_total').inc()
+        self.saved_by_other_process([
+            {'type': 'histogram', 'name': 'test_collect', 'labels': {},
+             'buckets': [[1, 1], [10, 1]], 'count': 1, 'sum': 0.5},
+            {'type': 'counter', 'name': 'test_collect_total', 'labels': {}, 'value': 3},
+        ], time.time())
+        records = metrics.collect()
+        histogram = self.find(records, 'test_collect')
+        assert histogram['buckets'] == [[1, 1], [10, 2]]
+        assert histogram['count'] == 2
+        assert self.find(records, 'test_collect_total')['value'] == 4
+
+    def test_gauges_keep_the_last_value(self):
+        metrics.gauge('test_gauge', node='centos7').set(5)
+        self.saved_by_other_process([
+            {'type': 'gauge', 'name': 'test_gauge', 'labels': {'node': 'centos7'}, 'value': 1},
+        ], time.time() - 60)
+        assert self.find(metrics.collect(), 'test_gauge', node='centos7')['value'] == 5
+
+    def test_gauges_saved_long_ago_are_left_out(self):
+        self.saved_by_other_process([
+            {'type': 'gauge', 'name': 'test_old_gauge', 'labels': {}, 'value': 1},
+        ], time.time() - metrics.gauge_max_age() - 1)
+        assert self.find(metrics.collect(), 'test_old_gauge') is None
+
+    def test_processes_that_are_gone_are_taken_over(self):
+        counter = {'type': 'counter', 'name': 'test_gone_total', 'labels': {}, 'value': 2}
+        gauge = {'type': 'gauge', 'name': 'test_gone_gauge', 'labels': {}, 'value': 1}
+        gone = self.saved_by_other_process(
+            [counter, gauge], time.time(), '%s.json' % self.dead_pid())
+        records = metrics.collect()
+        assert self.find(records, 'test_gone_total')['value'] == 2
+        assert self.find(records, 'test_gone_gauge') is None
+        assert not os.path.exists(gone)
+        # the totals are saved with the ones of this process, and not counted again
+        assert os.path.exists(os.path.join(metrics.metrics_dir(), '%s.json' % os.getpid()))
+        assert self.find(metrics.collect(), 'test_gone_total')['value'] == 2
+
+    def test_reused_pid_does_not_replace_older_totals(self, monkeypatch):
+        monkeypatch.setattr(metrics, '_saved_pid', None)
+        path = metrics.metrics_dir()
+        os.makedirs(path)
+        with open(os.path.join(path, '%s.json' % os.getpid()), 'w') as f:
+            json.dump({'saved': time.time(), 'metrics': [
+                {'type': 'histogram', 'name': 'test_reused', 'labels': {},
+                 'buckets': [[1, 1], [10, 1]], 'count': 1, 'sum': 0.5},
+            ]}, f)
+        metrics.histogram('test_reused', (1, 10)).observe(2)
+        metrics.save()
+        histogram = self.find(metrics.collect(), 'test_reused')
+        assert histogram['buckets'] == [[1, 1], [10, 2]]
+        assert histogram['count'] == 2
+
+    def test_own_file_is_not_counted_twice(self):
+        metrics.counter('test_own_total').inc()
+        metrics.save()
+        assert self.find(metrics.collect(), 'test_own_total')['value'] == 1
+
+    def test_recording_does_not_save(self):
+        metrics.counter('test_not_saved_total').inc()
+        assert not os.path.exists(metrics.metrics_dir())
+
+class TestRender(object):
+
+    def test_histograms(self):
+        text = metrics.render([
+            {'type': 'histogram', 'name': 'wait_seconds', 'labels': {'task': 'check'},
+             'buckets': [[0.5, 1], [1, 2]], 'count': 3, 'sum': 4.5},
+        ])
+        assert text.splitlines() == [
+            '# TYPE mita_wait_seconds histogram',
+            'mita_wait_seconds_bucket{task="check",le="0.5"} 1',
+            'mita_wait_seconds_bucket{task="check",le="1"} 2',
+            'mita_wait_seconds_bucket{task="check",le="+Inf"} 3',
+            'mita_wait_seconds_sum{task="check"} 4.5',
+            'mita_wait_seconds_count{task="check"} 3',
+        ]
+
+    def test_one_type_line_for_every_name(self):
+        text = metrics.render([
+            {'type': 'gauge', 'name': 'nodes', 'labels': {'state': 'idle'}, 'value': 1},
+            {'type': 'gauge', 'name': 'nodes', 'labels': {'state': 'active'}, 'value': 2},
+        ])
+        assert text.splitlines() == [
+            '# TYPE mita_nodes gauge',
+            'mita_nodes{state="idle"} 1',
+            'mita_nodes{state="active"} 2',
+        ]
+
+    def test_label_values_are_not_limited_to_ascii(self):
+        text = metrics.render([
+            {'type': 'gauge', 'name': 'stuck', 'labels': {'node': u'centos\u2019'}, 'value': 1},
+        ])
+        assert text == u'# TYPE mita_stuck gauge\nmita_stuck{node="centos\u2019"} 1\n'.encode('utf-8')
+
+    def test_label_values_are_escaped(self):
+        text = metrics.render([
+            {'type': 'counter', 'name': 'total', 'labels': {'endpoint': 'a"b'}, 'value': 1},
+        ])
+        assert 'mita_total{endpoint="a\\"b"} 1' in text
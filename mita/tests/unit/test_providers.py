@@ -1,16 +1,39 @@
+import base64
+import subprocess
 import pytest
 from collections import namedtuple
 from mock import Mock
 from mita import providers
 from mita.exceptions import CloudNodeNotFound
+from libcloud.common.exceptions import BaseHTTPError
+from pecan import set_config
+
+# other tests replace ``get_driver`` on the module, keep a reference to the
+# real one to test the caching behavior
+get_driver = providers.openstack.get_driver
+destroy_node = providers.openstack.destroy_node
+create_node = providers.openstack.create_node
+
+
+def openstack_conf(**kw):
+    openstack = {
+        'username': 'alfredo',
+        'password': 'secret',
+        'auth_url': 'http://openstack.example.com:5000',
+        'auth_version': '2.0_password',
+        'tenant_name': 'ci',
+        'service_region': 'Public',
+    }
+    openstack.update(kw)
+    return {'provider': {'openstack': openstack}}
 
 
 class TestOpenStackProvider(object):
 
     def setup(self):
+        set_config(openstack_conf(), overwrite=True)
         self.fake_get_driver = Mock()
-        self.node = namedtuple('Node', ['name', 'state'])
-        self.node.destroy = Mock()
+        self.node = namedtuple('Node', ['id', 'name', 'state'])
         self.fake_get_driver.return_value = self.fake_get_driver
 
     def test_destroy_node(self):
@@ -20,7 +43,7 @@ class TestOpenStackProvider(object):
             providers.openstack.destroy_node(name='foo')
 
     def test_destroy_node_api_fails(self):
-        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(name='foo', state=1)])
+        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(id='1', name='foo', state=1)])
         # a 0 return value will mean this node was not destroyed by the API
         self.fake_get_driver.destroy_node = Mock(return_value=0)
         providers.openstack.get_driver = self.fake_get_driver
@@ -28,7 +51,7 @@ class TestOpenStackProvider(object):
             providers.openstack.destroy_node(name='foo')
 
     def test_purge_succeeds(self):
-        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(name='foo', state=7)])
+        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(id='1', name='foo', state=7)])
         providers.openstack.get_driver = self.fake_get_driver
         assert providers.openstack.purge() is True
 
@@ -37,3 +60,349 @@ class TestOpenStackProvider(object):
         self.fake_get_driver.destroy_node = Mock(return_value=0)
         providers.openstack.get_driver = self.fake_get_driver
         assert providers.openstack.purge() is None
+
+
+class TestDriverCache(object):
+
+    def setup(self):
+        set_config(openstack_conf(), overwrite=True)
+        providers.openstack.invalidate_driver()
+        providers.openstack.driver_cache_stats.update(hits=0, misses=0)
+
+    def fake_driver(self, auth_token=None, valid=True):
+        driver = Mock()
+        driver.connection._osa.auth_token = auth_token
+        driver.connection._osa.is_token_valid.return_value = valid
+        return driver
+
+    def test_driver_is_reused(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'OpenStack', lambda *a, **kw: self.fake_driver())
+        assert get_driver() is get_driver()
+        assert providers.openstack.driver_cache_stats == {'hits': 1, 'misses': 1}
+
+    def test_expired_token_builds_a_new_driver(self, monkeypatch):
+        monkeypatch.setattr(
+            providers.openstack, 'OpenStack',
+            lambda *a, **kw: self.fake_driver(auth_token='token', valid=False))
+        first = get_driver()
+        assert get_driver() is not first
+        assert providers.openstack.driver_cache_stats == {'hits': 0, 'misses': 2}
+
+    def test_invalidate_builds_a_new_driver(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'OpenStack', lambda *a, **kw: self.fake_driver())
+        first = get_driver()
+        providers.openstack.invalidate_driver()
+        assert get_driver() is not first
+
+    def test_reauthenticates_on_invalid_credentials(self):
+        calls = []
+
+        @providers.openstack.reauthenticate_on_failure
+        def api_call():
+            calls.append(1)
+            if len(calls) == 1:
+                raise BaseHTTPError(401, 'Unauthorized')
+            return True
+
+        assert api_call() is True
+        assert len(calls) == 2
+
+    def test_reauthentication_is_attempted_once(self):
+
+        @providers.openstack.reauthenticate_on_failure
+        def api_call():
+            raise BaseHTTPError(401, 'Unauthorized')
+
+        with pytest.raises(BaseHTTPError):
+            api_call()
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        @providers.openstack.reauthenticate_on_failure
+        def api_call():
+            calls.append(1)
+            raise BaseHTTPError(500, 'Internal Server Error')
+
+        with pytest.raises(BaseHTTPError):
+            api_call()
+        assert len(calls) == 1
+
+
+class TestCatalogCache(object):
+
+    def setup(self):
+        set_config(openstack_conf(catalog_ttl=600), overwrite=True)
+        providers.openstack.invalidate_catalog()
+        self.image = namedtuple('Image', ['id', 'name'])
+        self.size = namedtuple('Size', ['id', 'name'])
+        self.driver = Mock()
+        self.driver.list_images.return_value = [self.image('1', 'centos7')]
+        self.driver.list_sizes.return_value = [self.size('10', 'huge')]
+
+    def test_lookup_maps_names_to_ids(self):
+        result = providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        assert result == ('1', '10', True)
+
+    def test_lookup_is_cached(self):
+        providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        result = providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        assert result == ('1', '10', False)
+        assert self.driver.list_images.call_count == 1
+
+    def test_invalidate_fetches_again(self):
+        providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        providers.openstack.invalidate_catalog()
+        providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        assert self.driver.list_images.call_count == 2
+
+    def test_unknown_name_forces_a_refresh(self):
+        providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        result = providers.openstack.lookup_catalog(self.driver, 'xenial', 'huge')
+        assert result == (None, '10', True)
+        assert self.driver.list_images.call_count == 2
+
+    def test_rejected_cached_id_refreshes_the_catalog(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        providers.openstack.lookup_catalog(self.driver, 'centos7', 'huge')
+        self.driver.list_images.return_value = [self.image('2', 'centos7')]
+        self.driver.create_node.side_effect = [
+            BaseHTTPError(400, 'Can not find requested image'), 'new node'
+        ]
+        result = providers.openstack._boot_node(
+            name='centos7__1', image_name='centos7', size='huge',
+            script='', keyname='key')
+        assert result == 'new node'
+        assert self.driver.create_node.call_args[1]['image'].id == '2'
+
+
+class TestProviderIds(object):
+
+    def setup(self):
+        self.driver = Mock()
+        self.driver.list_volumes.return_value = []
+        self.node = namedtuple('Node', ['id', 'name', 'state'])
+
+    def test_destroy_node_by_id_does_not_list_nodes(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        destroy_node(name='foo', provider_id='1234')
+        assert self.driver.destroy_node.call_args[0][0].id == '1234'
+        assert not self.driver.list_nodes.called
+
+    def test_destroy_node_by_id_not_found(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.destroy_node.side_effect = BaseHTTPError(404, 'Instance could not be found')
+        with pytest.raises(CloudNodeNotFound):
+            destroy_node(name='foo', provider_id='1234')
+
+    def test_destroy_node_falls_back_to_name(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.list_nodes.return_value = [self.node('1234', 'foo', 0)]
+        destroy_node(name='foo')
+        assert self.driver.destroy_node.call_args[0][0].id == '1234'
+
+    def test_destroy_node_deletes_the_volume_by_id(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        destroy_node(name='foo', provider_id='1234', volume_id='v-1', storage=10)
+        assert self.driver.destroy_volume.call_args[0][0].id == 'v-1'
+        assert not self.driver.list_volumes.called
+
+    def test_destroy_node_with_a_volume_that_is_gone(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.destroy_volume.side_effect = BaseHTTPError(404, 'Volume could not be found')
+        destroy_node(name='foo', provider_id='1234', volume_id='v-1', storage=10)
+
+    def test_destroy_node_without_storage_does_not_list_volumes(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        destroy_node(name='foo', provider_id='1234', storage=0)
+        assert not self.driver.list_volumes.called
+        assert not self.driver.destroy_volume.called
+
+    def test_destroy_node_looks_up_older_volumes_by_name(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        volume = namedtuple('Volume', ['name', 'state'])('foo', 'in_use')
+        self.driver.list_volumes.return_value = [volume]
+        destroy_node(name='foo', provider_id='1234', storage=10)
+        assert self.driver.destroy_volume.call_args[0][0] is volume
+
+    def test_destroy_node_with_unknown_storage_looks_up_the_volume(self, monkeypatch):
+        # rows from before the storage columns were added have them NULL
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        volume = namedtuple('Volume', ['name', 'state'])('foo', 'in_use')
+        self.driver.list_volumes.return_value = [volume]
+        self.driver.destroy_volume.side_effect = BaseHTTPError(404, 'Volume could not be found')
+        destroy_node(name='foo', provider_id='1234', storage=None)
+        assert self.driver.destroy_volume.call_args[0][0] is volume
+
+    def test_node_status_by_id(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.ex_get_node_details.return_value = self.node('1234', 'foo', 0)
+        assert providers.openstack.node_status('foo', provider_id='1234') == 0
+        assert not self.driver.list_nodes.called
+
+    def test_node_status_not_found(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.list_nodes.return_value = []
+        with pytest.raises(CloudNodeNotFound):
+            providers.openstack.node_status('foo')
+
+    def test_node_status_reauthenticates(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.ex_get_node_details.side_effect = [
+            BaseHTTPError(401, 'Unauthorized'), self.node('1234', 'foo', 0)
+        ]
+        assert providers.openstack.node_status('foo', provider_id='1234') == 0
+
+    def test_node_status_by_id_not_found(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.ex_get_node_details.side_effect = BaseHTTPError(404, 'Not Found')
+        with pytest.raises(CloudNodeNotFound):
+            providers.openstack.node_status('foo', provider_id='1234')
+
+
+class TestInventory(object):
+
+    def setup(self):
+        set_config(openstack_conf(inventory_ttl=600), overwrite=True)
+        self.driver = Mock()
+        self.driver.list_volumes.return_value = []
+        self.node = namedtuple('Node', ['id', 'name', 'state'])
+        self.driver.list_nodes.return_value = [
+            self.node('1', 'foo', 0), self.node('2', 'bar', 7)
+        ]
+
+    def test_indexed_by_name_and_id(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        by_name, by_id = providers.openstack.get_inventory()
+        assert by_name['foo'] is by_id['1']
+        assert sorted(by_id) == ['1', '2']
+
+    def test_listing_is_reused(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        destroy_node(name='foo')
+        providers.openstack.node_status('bar')
+        providers.openstack.purge()
+        assert self.driver.list_nodes.call_count == 1
+
+    def test_expired_listing_is_fetched_again(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        providers.openstack.get_inventory()
+        monkeypatch.setattr(providers.openstack, 'time', lambda: 2 ** 40)
+        providers.openstack.get_inventory()
+        assert self.driver.list_nodes.call_count == 2
+
+    def test_destroyed_node_is_forgotten(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        destroy_node(name='foo')
+        by_name, by_id = providers.openstack.get_inventory()
+        assert 'foo' not in by_name
+        assert '1' not in by_id
+
+    def test_purged_node_is_forgotten(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        assert providers.openstack.purge() is True
+        by_name, by_id = providers.openstack.get_inventory()
+        assert sorted(by_id) == ['1']
+
+    def test_purge_skips_nodes_that_are_gone(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.list_nodes.return_value.append(self.node('3', 'baz', 7))
+        self.driver.destroy_node.side_effect = [
+            BaseHTTPError(404, 'Instance could not be found'), True
+        ]
+        assert providers.openstack.purge() is True
+        assert self.driver.destroy_node.call_count == 2
+        by_name, by_id = providers.openstack.get_inventory()
+        assert sorted(by_id) == ['1']
+
+    def test_unknown_name_lists_again(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        providers.openstack.get_inventory()
+        with pytest.raises(CloudNodeNotFound):
+            destroy_node(name='baz')
+        assert self.driver.list_nodes.call_count == 2
+
+    def test_unknown_name_does_not_list_again(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        providers.openstack.get_inventory()
+        with pytest.raises(CloudNodeNotFound):
+            destroy_node(name='baz', refresh_on_miss=False)
+        assert self.driver.list_nodes.call_count == 1
+
+    def test_creating_a_node_invalidates_the_listing(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        monkeypatch.setattr(providers.openstack, '_boot_node', lambda **kw: self.node('3', 'baz', 0))
+        providers.openstack.get_inventory()
+        assert create_node(name='baz') == '3'
+        providers.openstack.get_inventory()
+        assert self.driver.list_nodes.call_count == 2
+
+
+class TestBatchCreate(object):
+
+    def setup(self):
+        set_config(openstack_conf(), overwrite=True)
+        providers.openstack.invalidate_catalog()
+        image = namedtuple('Image', ['id', 'name'])
+        size = namedtuple('Size', ['id', 'name'])
+        self.driver = Mock()
+        self.driver.list_images.return_value = [image('1', 'centos7')]
+        self.driver.list_sizes.return_value = [size('10', 'huge')]
+        self.kw = dict(
+            name='centos7', image_name='centos7', size='huge',
+            keyname='key', script='nodename=centos7__%s'
+        )
+
+    def response(self, obj):
+        response = Mock()
+        response.object = obj
+        return response
+
+    def test_boots_all_servers_in_one_call(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.connection.request.side_effect = [
+            self.response({'reservation_id': 'r-1'}),
+            self.response({'servers': [{'id': 'a'}, {'id': 'b'}]}),
+        ]
+        assert providers.openstack.create_nodes(2, **self.kw) == ['a', 'b']
+        server = self.driver.connection.request.call_args_list[0][1]['data']['server']
+        assert server['min_count'] == server['max_count'] == 2
+
+    def test_user_data_gets_the_server_id(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.connection.request.side_effect = [
+            self.response({'reservation_id': 'r-1'}),
+            self.response({'servers': []}),
+        ]
+        providers.openstack.create_nodes(2, **self.kw)
+        server = self.driver.connection.request.call_args_list[0][1]['data']['server']
+        user_data = base64.b64decode(server['user_data'])
+        assert user_data == providers.openstack.batch_user_data('nodename=centos7__%s')
+
+    def run_user_data(self, tmpdir, monkeypatch, script):
+        instance_id = tmpdir.join('instance-id')
+        instance_id.write('1234-abcd')
+        monkeypatch.setattr(providers.openstack, 'INSTANCE_ID_PATH', str(instance_id))
+        user_data = tmpdir.join('user-data')
+        user_data.write(providers.openstack.batch_user_data(script), mode='wb')
+        return subprocess.check_output(['sh', str(user_data)])
+
+    def test_user_data_puts_the_server_id_in_quotes(self, tmpdir, monkeypatch):
+        script = "#!/bin/sh\necho 'nodename=centos7__%s' \"100%%\"\n"
+        output = self.run_user_data(tmpdir, monkeypatch, script)
+        assert output == 'nodename=centos7__1234-abcd 100%\n'
+
+    def test_user_data_is_not_limited_to_ascii(self, tmpdir, monkeypatch):
+        script = u"#!/bin/sh\necho '\u2018%s\u2019'\n"
+        output = self.run_user_data(tmpdir, monkeypatch, script)
+        assert output.decode('utf-8') == u'\u20181234-abcd\u2019\n'
+
+    def test_batches_not_supported(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.connection.request.return_value = self.response({'server': {'id': 'a'}})
+        assert providers.openstack.create_nodes(2, **self.kw) == ['a']
+
+    def test_batch_is_rejected(self, monkeypatch):
+        monkeypatch.setattr(providers.openstack, 'get_driver', lambda: self.driver)
+        self.driver.connection.request.side_effect = BaseHTTPError(400, 'Bad request')
+        assert providers.openstack.create_nodes(2, **self.kw) == []
@@ -2,7 +2,7 @@ import requests
 import pytest
 
 from pecan import set_config
-from mita import util
+from mita import util, label_eval
 
 
 from mock import patch, MagicMock
@@ -270,6 +270,56 @@ class TestGetNodeLabels(object):
         assert result == ['amd64', 'centos7', 'x86_64', 'huge']
 
 
+class TestNodeLabelsCache(object):
+
+    def setup(self):
+        set_config(
+            {'jenkins': {
+                'url': 'http://jenkins.example.com',
+                'user': 'alfredo',
+                'token': 'secret'}},
+            overwrite=True
+        )
+        self.conn = MagicMock()
+        self.conn.get_node_config.return_value = (
+            '<slave><label>arm64 xenial</label></slave>'
+        )
+
+    @patch("mita.util.jenkins_connection")
+    @patch("mita.util.get_jenkins_nodes")
+    def test_labels_of_all_agents_with_one_request(self, m_nodes, m_connection):
+        m_connection.return_value = self.conn
+        m_nodes.return_value = [
+            {'name': 'trusty-static', 'labels': ['amd64', 'trusty']},
+            {'name': 'xenial-static', 'labels': ['amd64', 'xenial']},
+        ]
+        assert util.get_node_labels('trusty-static') == ['amd64', 'trusty']
+        assert util.get_node_labels('xenial-static') == ['amd64', 'xenial']
+        assert m_nodes.call_count == 1
+        assert not self.conn.get_node_config.called
+
+    @patch("mita.util.jenkins_connection")
+    @patch("mita.util.get_jenkins_nodes")
+    def test_unknown_agent_is_not_fetched(self, m_nodes, m_connection):
+        m_connection.return_value = self.conn
+        m_nodes.return_value = [{'name': 'trusty-static', 'labels': ['amd64']}]
+        assert util.get_node_labels('amd64&&trusty') == []
+        assert not self.conn.get_node_config.called
+
+    @patch("mita.util.jenkins_connection")
+    @patch("mita.util.get_jenkins_nodes")
+    def test_falls_back_to_the_agent_config(self, m_nodes, m_connection):
+        m_connection.return_value = self.conn
+        m_nodes.side_effect = requests.exceptions.RequestException()
+        assert util.get_node_labels('xenial-static') == ['arm64', 'xenial']
+
+    def test_parsing_stops_at_label(self):
+        labels = '<slave><label>amd64 huge</label>'
+        xml = labels + '<broken' * 5000
+        result = util.parse_node_labels(xml, chunk_size=len(labels))
+        assert result == ['amd64', 'huge']
+
+
 stuck_reasons = [
     "Waiting for next available executor on 10.0.1.1",
     "All nodes of label awesomest are busy",
@@ -297,6 +347,105 @@ class TestIsStuck(object):
         assert util.is_stuck(why) is False
 
 
+class TestLabelIndex(object):
+
+    def setup(self):
+        self.nodes = {
+            'centos6': {'labels': ['x86_64', 'centos', 'small']},
+            'trusty': {'labels': ['x86_64', 'trusty', 'huge']},
+        }
+        set_config({'nodes': self.nodes}, overwrite=True)
+
+    def test_maps_label_to_node_types(self):
+        index = util.get_label_index()
+        assert sorted(index.by_label['x86_64']) == ['centos6', 'trusty']
+        assert index.by_label['huge'] == ['trusty']
+
+    def test_stores_labels_as_sets(self):
+        index = util.get_label_index()
+        assert index.labels['centos6'] == set(['x86_64', 'centos', 'small'])
+
+    def test_is_reused_while_config_does_not_change(self):
+        assert util.get_label_index() is util.get_label_index()
+
+    def test_is_rebuilt_when_config_changes(self):
+        index = util.get_label_index()
+        self.nodes['centos7'] = {'labels': ['centos7']}
+        set_config({'nodes': self.nodes}, overwrite=True)
+        assert util.get_label_index() is not index
+        assert util.match_node_from_label('centos7') == 'centos7'
+
+    def test_matches_all_labels(self):
+        assert util.match_node_from_labels(['huge', 'x86_64']) == 'trusty'
+
+    def test_does_not_match_unknown_label(self):
+        assert util.match_node_from_labels(['huge', 'arm64']) is None
+
+    def test_matches_with_explicit_nodes(self):
+        nodes = {'wheezy': {'labels': ['amd64']}}
+        assert util.match_node_from_label('amd64', nodes) == 'wheezy'
+
+
+class TestClassifyStuck(object):
+
+    def test_busy(self):
+        reason = util.classify_stuck(
+            u"Waiting for next available executor on \u2018wheezy\u2019"
+        )
+        assert reason == ('busy', 'wheezy')
+
+    def test_offline_label(self):
+        reason = util.classify_stuck(BecauseLabelIsOffline % 'amd64&&trusty')
+        assert reason == ('offline_label', 'amd64&&trusty')
+
+    def test_offline_node(self):
+        reason = util.classify_stuck(BecauseNodeIsOffline % 'wheezy__10.0.0.1')
+        assert reason == ('offline_node', 'wheezy__10.0.0.1')
+
+    def test_offline_node_label(self):
+        reason = util.classify_stuck(BecauseNodeLabelIsOffline % 'debian')
+        assert reason == ('offline_node_label', 'debian')
+
+    def test_offline_node_wins_over_offline_node_label(self):
+        reason = util.classify_stuck(
+            u"There are no nodes with the label \u2018x\u2019;wheezy is offline"
+        )
+        assert reason.kind == 'offline_node'
+
+    def test_label_is_missing_collects_every_label(self):
+        api_message = ';'.join([
+            BecauseNodeIsOffline % 'wheezy',
+            BecauseLabelIsMissing % ('node1', 'small&&ovh'),
+            BecauseLabelIsMissing % ('node2', 'x86_64'),
+        ])
+        reason = util.classify_stuck(api_message)
+        assert reason == ('without_label', ['small&&ovh', 'x86_64'])
+
+    @pytest.mark.parametrize('why', garbage_reasons)
+    def test_garbage_is_not_classified(self, why):
+        assert util.classify_stuck(why) is None
+
+
+class TestMatchReason(object):
+
+    def setup(self):
+        set_config(
+            {'nodes': {'wheezy': {'labels': ['amd64', 'debian']}}},
+            overwrite=True
+        )
+
+    def test_none_does_not_break(self):
+        assert util.match_reason(None) is None
+
+    def test_matches_classified_reason(self):
+        reason = util.classify_stuck(BecauseNodeLabelIsOffline % 'debian&&amd64')
+        assert util.match_reason(reason) == 'wheezy'
+
+    def test_matches_offline_node(self):
+        reason = util.classify_stuck(BecauseNodeIsOffline % 'wheezy__10.0.0.1')
+        assert util.match_reason(reason) == 'wheezy'
+
+
 class TestFromOfflineExecutor(object):
     def setup(self):
         set_config(
@@ -370,29 +519,217 @@ class TestMatchNodeFromJobConfig(object):
                 'token': 'secret'},
         }
         set_config(self.default_conf, overwrite=True)
+        util._job_labels.clear()
+        self.job_url = "https://jenkins.ceph.com/job/ceph-pull-requests"
 
-    @patch("mita.util.requests")
-    def test_finds_labels(self, m_requests):
+    def response(self, job_config='', status_code=200, headers=None):
         mock_response = MagicMock()
+        mock_response.status_code = status_code
+        mock_response.headers = headers or {}
+        mock_response.iter_content.return_value = [job_config]
+        return mock_response
+
+    @patch("mita.util.jenkins_session")
+    def test_finds_labels(self, m_session):
         job_config = '<?xml version="1.0" encoding="UTF-8"?><project><assignedNode>amd64 &amp;&amp; debian</assignedNode></project>'
-        mock_response.text = job_config
-        m_requests.get.return_value = mock_response
-        result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
+        m_session.return_value.get.return_value = self.response(job_config)
+        result = util.match_node_from_job_config(self.job_url)
         assert result == "wheezy"
 
-    @patch("mita.util.requests")
-    def test_does_not_find_labels(self, m_requests):
-        mock_response = MagicMock()
+    @patch("mita.util.jenkins_session")
+    def test_does_not_find_labels(self, m_session):
         job_config = '<?xml version="1.0" encoding="UTF-8"?><project></project>'
-        mock_response.text = job_config
-        m_requests.get.return_value = mock_response
-        result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
+        m_session.return_value.get.return_value = self.response(job_config)
+        result = util.match_node_from_job_config(self.job_url)
         assert not result
 
-    @patch("mita.util.requests")
-    def test_failed_to_fetch_job_config(self, m_requests):
-        mock_response = MagicMock()
+    @patch("mita.util.jenkins_session")
+    def test_failed_to_fetch_job_config(self, m_session):
+        mock_response = self.response()
         mock_response.raise_for_status.side_effect = requests.exceptions.RequestException()
-        m_requests.get.return_value = mock_response
-        result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
+        m_session.return_value.get.return_value = mock_response
+        result = util.match_node_from_job_config(self.job_url)
         assert not result
+        assert not util.job_labels_are_cached(self.job_url)
+
+    @patch("mita.util.jenkins_session")
+    def test_cache_is_bounded(self, m_session, monkeypatch):
+        monkeypatch.setattr(util, '_job_labels', label_eval.LRUCache(2))
+        job_config = '<project><assignedNode>debian</assignedNode></project>'
+        m_session.return_value.get.return_value = self.response(job_config)
+        for job in ('first', 'second', 'third'):
+            util.match_node_from_job_config('%s-%s' % (self.job_url, job))
+        assert len(util._job_labels) == 2
+        assert not util.job_labels_are_cached('%s-first' % self.job_url)
+
+    @patch("mita.util.jenkins_session")
+    def test_revalidates_cached_config(self, m_session):
+        job_config = '<project><assignedNode>debian</assignedNode></project>'
+        get = m_session.return_value.get
+        get.return_value = self.response(job_config, headers={'ETag': '"abc"'})
+        util.match_node_from_job_config(self.job_url)
+        not_modified = self.response(status_code=304)
+        get.return_value = not_modified
+        assert util.match_node_from_job_config(self.job_url) == "wheezy"
+        assert get.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
+        assert not not_modified.iter_content.called
+
+
+class TestParseAssignedNode(object):
+
+    def test_stops_parsing_after_assigned_node(self):
+        chunks = iter([
+            '<project><description>a job</description>',
+            '<assignedNode>amd64 &amp;&amp; debian</assignedNode>',
+            '<builders>this is never parsed',
+        ])
+        assert util.parse_assigned_node(chunks) == 'amd64 && debian'
+        assert list(chunks) == ['<builders>this is never parsed']
+
+    def test_assigned_node_split_across_chunks(self):
+        chunks = ['<project><assigned', 'Node>amd', '64</assignedNode></project>']
+        assert util.parse_assigned_node(chunks) == 'amd64'
+
+    def test_ignores_nested_assigned_node(self):
+        chunks = ['<project><axes><assignedNode>x</assignedNode></axes></project>']
+        assert util.parse_assigned_node(chunks) is None
+
+
+class TestNodesToCreate(object):
+
+    def test_no_existing_nodes_creates_buffered_count(self):
+        assert util.nodes_to_create(4, existing=0, recent=0) == 3
+
+    def test_buffered_count_rounds_up(self):
+        assert util.nodes_to_create(1, existing=0, recent=0) == 1
+
+    def test_enough_recent_nodes(self):
+        assert util.nodes_to_create(2, existing=5, recent=2) == 0
+
+    def test_not_enough_recent_nodes(self):
+        assert util.nodes_to_create(4, existing=5, recent=1) == 3
+
+
+class TestBackoffDelay(object):
+
+    @pytest.mark.parametrize('attempt', range(10))
+    def test_delay_is_capped(self, attempt):
+        assert util.backoff_delay(attempt, cap=30) <= 30
+
+    def test_delay_grows(self):
+        assert util.backoff_delay(0) <= 2
+        assert util.backoff_delay(4) >= 16
+
+
+class TestGetJenkinsNodes(object):
+
+    def setup(self):
+        set_config(
+            {'jenkins': {
+                'url': 'http://jenkins.example.com',
+                'user': 'alfredo',
+                'token': 'secret'}},
+            overwrite=True
+        )
+
+    @patch("mita.util.jenkins_session")
+    def test_single_request_for_all_nodes(self, m_session):
+        m_session.return_value.get.return_value.json.return_value = {'computer': [
+            {'displayName': 'master', 'idle': True, 'offline': False,
+             'numExecutors': 2, 'executors': [{'idle': True}, {'idle': True}]},
+            {'displayName': 'centos7__aaaa', 'idle': False, 'offline': False,
+             'numExecutors': 2, 'executors': [{'idle': False}, {'idle': True}]},
+        ]}
+        result = util.get_jenkins_nodes()
+        assert m_session.return_value.get.call_count == 1
+        assert result[1] == {
+            'name': 'centos7__aaaa', 'idle': False, 'offline': False,
+            'executors': 2, 'busy_executors': 1, 'labels': [],
+        }
+
+    @patch("mita.util.jenkins_session")
+    def test_labels_without_the_agent_name(self, m_session):
+        m_session.return_value.get.return_value.json.return_value = {'computer': [
+            {'displayName': 'trusty-static', 'assignedLabels': [
+                {'name': 'amd64'}, {'name': 'trusty-static'}, {'name': 'huge'}]},
+        ]}
+        assert util.get_jenkins_nodes()[0]['labels'] == ['amd64', 'huge']
+
+    @patch("mita.util.jenkins_session")
+    def test_asks_for_a_narrow_tree(self, m_session):
+        m_session.return_value.get.return_value.json.return_value = {'computer': []}
+        util.get_jenkins_nodes()
+        assert m_session.return_value.get.call_args[1]['params'] == {'tree': util.JENKINS_NODES_TREE}
+
+
+class TestJenkinsAgents(object):
+
+    def setup(self):
+        set_config(
+            {'jenkins': {
+                'url': 'http://jenkins.example.com',
+                'user': 'alfredo',
+                'token': 'secret'}},
+            overwrite=True
+        )
+        self.agents = [
+            {'name': 'master', 'idle': True, 'labels': []},
+            {'name': 'centos7__aaaa', 'idle': False, 'labels': ['centos7']},
+            {'name': 'custom-bbbb', 'idle': True, 'labels': ['amd64']},
+        ]
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_snapshot_is_shared(self, m_nodes):
+        m_nodes.return_value = self.agents
+        assert util.get_jenkins_agents()['custom-bbbb']['idle'] is True
+        assert util.get_jenkins_name('aaaa') == 'centos7__aaaa'
+        assert util.get_node_labels('custom-bbbb') == ['amd64']
+        assert m_nodes.call_count == 1
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_lists_agents_again_when_asked(self, m_nodes):
+        m_nodes.return_value = self.agents
+        util.get_jenkins_agents()
+        util.get_jenkins_agents(refresh=True)
+        assert m_nodes.call_count == 2
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_lists_agents_again_when_expired(self, m_nodes, monkeypatch):
+        m_nodes.return_value = self.agents
+        util.get_jenkins_agents()
+        monkeypatch.setattr(util.time, 'time', lambda: 2 ** 40)
+        util.get_jenkins_agents()
+        assert m_nodes.call_count == 2
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_name_of_node_without_naming_convention(self, m_nodes):
+        m_nodes.return_value = self.agents
+        assert util.get_jenkins_name('bbbb') == 'custom-bbbb'
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_lists_agents_again_on_a_miss(self, m_nodes):
+        m_nodes.return_value = self.agents
+        util.load_jenkins_agents(self.agents[:1])
+        assert util.get_jenkins_name('aaaa') == 'centos7__aaaa'
+        assert m_nodes.call_count == 1
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_does_not_list_agents_on_a_miss(self, m_nodes):
+        util.load_jenkins_agents(self.agents[:1])
+        assert util.get_jenkins_name('aaaa', refresh_on_miss=False) is None
+        assert m_nodes.call_count == 0
+
+    @patch("mita.util.jenkins_connection")
+    def test_deleted_agents_are_invalidated(self, m_connection):
+        util.load_jenkins_agents(self.agents)
+        util.delete_jenkins_node('centos7__aaaa')
+        assert util.get_jenkins_name('aaaa', refresh_on_miss=False) is None
+        assert 'centos7__aaaa' not in util.get_jenkins_agents()
+
+    @patch("mita.util.get_jenkins_nodes")
+    def test_invalidating_all_agents(self, m_nodes):
+        m_nodes.return_value = self.agents
+        util.get_jenkins_agents()
+        util.invalidate_jenkins_agents()
+        util.get_jenkins_agents()
+        assert m_nodes.call_count == 2
@@ -1,14 +1,19 @@
+from collections import namedtuple
+from datetime import datetime
 from xml.etree import ElementTree
 from libcloud.compute import types
 from jenkins import NotFoundException as JenkinsNotFoundException
 from pecan import conf
 import logging
 import os
-import requests
+import random
+import re
+import time
 
-from mita.connections import jenkins_connection
+from mita import providers
+from mita.connections import jenkins_connection, jenkins_session
 from mita.exceptions import CloudNodeNotFound
-from mita.label_eval import matching_nodes
+from mita.label_eval import matching_nodes, LRUCache
 
 
 logger = logging.getLogger(__name__)
@@ -72,54 +77,142 @@ def get_key(_dict, key, fallback=True):
             if name in key:
                 return name
 
-# TODO: all these need proper logging
-# Stuck Queue Processors
+def seconds_since(timestamp, now=None):
+    """
+    Total seconds elapsed since ``timestamp``, unlike ``timedelta.seconds``
+    this does not drop the days.
+    """
+    difference = (now or datetime.utcnow()) - timestamp
+    return difference.days * 86400 + difference.seconds
 
 
-def is_stuck(string):
+def backoff_delay(attempt, base=2, cap=60):
     """
-    The Jenkins API might not cooperate with proper information, when a job is
-    stuck it may be sending out messages as it was stuck, but the
-    status['stuck'] will be False. This helper will check for the strings that
-    mita supports for stuck jobs.
+    Exponential backoff capped at ``cap`` seconds. Half of the delay is random
+    (jitter) so that many waiters started at the same time do not poll the
+    provider in lockstep.
+    """
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+# nodes created less than this many seconds ago are probably still getting
+# provisioned (or just started to work)
+RECENT_NODE_SECONDS = 360  # 6 minutes
+
+# nodes that haven't joined Jenkins after this many seconds never will
+ORPHAN_SECONDS = 900  # 15 minutes
+
+# nodes idle for more than this many seconds get destroyed
+IDLE_SECONDS = 2400  # 40 minutes
+
+
+def nodes_to_create(needed, existing, recent):
     """
-    def busy_summary(string): return string.startswith('Waiting for')
+    Decide how many nodes to create for jobs that need ``needed`` nodes to get
+    unstuck, given how many nodes of the same type and labels ``existing``
+    and how many of those were created ``recent``-ly.
 
-    def offline_label_summary(string): return string.startswith('All nodes of label')
+    If there are no nodes at all, or not enough of them have been created
+    recently (the rest are probably busy) this is a buffered count: 3/4 of
+    what is needed rounded up. Otherwise the recent ones are going to pick up
+    the jobs and nothing needs to be created.
+    """
+    buffered_count = int(round(needed * 0.75))
+    if not existing:
+        return buffered_count
+    if recent >= needed:
+        return 0
+    return buffered_count
 
-    def offline_node_summary(string): return string.endswith('is offline')
+# TODO: all these need proper logging
+# Stuck Queue Processors
 
-    def offline_node_label_summary(string): return string.startswith('There are no nodes')
+NOT_HAVING_LABEL = u"doesn\u2019t have label"
 
-    def node_does_not_have_label(string): return u"doesn\u2019t have label" in string
+StuckReason = namedtuple('StuckReason', ['kind', 'value'])
 
-    for summary in [
-        busy_summary,
-        offline_label_summary,
-        offline_node_summary,
-        offline_node_label_summary,
-        node_does_not_have_label
-    ]:
-        if summary(string) is True:
-            return True
-    return False
+# a queue item can only start with one of these, so a single match tells
+# which of the prefixed reasons (if any) it is
+_stuck_prefixes = re.compile(
+    u'(?P<busy>Waiting for)'
+    u'|(?P<offline_label>All nodes of label)'
+    u'|(?P<offline_node_label>There are no nodes)'
+)
+
+
+def _last_word(string):
+    try:
+        return sanitize_string(string.split()[-1])
+    except IndexError:
+        return None
+
+
+def classify_stuck(string):
+    """
+    Parse the reason a job is stuck in the Jenkins queue (its ``why``) only
+    once, and return a ``StuckReason`` with the ``kind`` of reason and the
+    ``value`` needed to match a configured node for it:
+
+    * ``busy``: the node or label (or label expression) in "Waiting for next
+      available executor on {0}"
+    * ``offline_label``: the label in "All nodes of label {0} are offline"
+    * ``offline_node``: the node in "{0} is offline"
+    * ``offline_node_label``: the label in "There are no nodes with the label {0}"
+    * ``without_label``: a list with the label of every "{0} doesn't have
+      label {1}" message
+
+    The Jenkins API might not cooperate with proper information, when a job is
+    stuck it may be sending out messages as it was stuck, but the
+    status['stuck'] will be False. ``None`` is returned when the string is not
+    one that mita supports for stuck jobs.
+    """
+    prefix = _stuck_prefixes.match(string)
+    kind = prefix.lastgroup if prefix else None
+    # the order in which these are checked matters, the first one wins
+    if kind == 'busy':
+        return StuckReason(kind, _last_word(string))
+    if kind == 'offline_label':
+        # effing unicode to have nice cute quotes in the UI
+        return StuckReason(kind, sanitize_string(string).split()[-3])
+    if string.endswith('is offline'):
+        return StuckReason('offline_node', string.split()[0])
+    if kind == 'offline_node_label':
+        return StuckReason(kind, sanitize_string(string).split()[-1])
+    if NOT_HAVING_LABEL in string:
+        labels = [
+            _last_word(message) for message in string.split(';')
+            if NOT_HAVING_LABEL in message
+        ]
+        return StuckReason('without_label', labels)
+    return None
+
+
+def is_stuck(string):
+    """
+    Check for the strings that mita supports for stuck jobs, see
+    :func:`classify_stuck`
+    """
+    return classify_stuck(string) is not None
 
 
 def match_node(string):
     """
     Determine what node, if any, is needed from a given state of a Jenkins
-    Queue. There are three distinct states from the API, so process it and
+    Queue. There are a few distinct states from the API, so process it and
     determine if we are able to match it to a configured node.
     """
-    busy_summary = lambda string: from_label if string.startswith('Waiting for') else None
-    offline_label_summary = lambda string: from_offline_label if string.startswith('All nodes of label') else None
-    offline_node_summary = lambda string: from_offline_node if string.endswith('is offline') else None
-    offline_node_label_summary = lambda string: from_offline_node_label if string.startswith('There are no nodes') else None
-    node_does_not_have_label = lambda string: from_node_without_label if u"doesn\u2019t have label" in string else None
-    for summary in [busy_summary, offline_label_summary, offline_node_summary, offline_node_label_summary, node_does_not_have_label]:
-        processor = summary(string)
-        if processor:
-            return processor(string)
+    return match_reason(classify_stuck(string))
+
+
+def match_reason(reason):
+    """
+    Match an already classified ``StuckReason`` to a configured node, so that
+    callers that need both the classification and the match don't have to
+    parse the string twice.
+    """
+    if reason is None:
+        return None
+    return _reason_matchers[reason.kind](reason.value)
 
 
 def from_label(string):
@@ -138,13 +231,15 @@ def from_label(string):
     strings, this is why the ``string`` needs to be sanitized before
     processing.
     """
-    try:
-        node_or_label = string.split()[-1]
-    except IndexError:
+    node_or_label = _last_word(string)
+    if node_or_label is None:
         return None
-    node_or_label = sanitize_string(node_or_label)
+    return _match_node_or_label(node_or_label)
+
+
+def _match_node_or_label(node_or_label):
     node_from_label = match_node_from_label(node_or_label)
-    configured_nodes = get_nodes()
+    configured_nodes = get_label_index().nodes
     # node_or_label can be a node as a key in the config, so try to get that
     # first, and use the match from labels as a fallback. Try first with no
     # sanitizing of the node name, and if that doesn't work, try by splitting
@@ -190,11 +285,13 @@ def from_offline_node_label(string):
 
         u"There are no nodes with the label \u2018{0}\u2019"
     """
-    string = sanitize_string(string)
-    label = string.split()[-1]
+    return _match_offline_node_label(sanitize_string(string).split()[-1])
+
+
+def _match_offline_node_label(label):
     matched_node = match_node_from_label(label)
     if matched_node is None:
-        nodes = get_nodes()
+        nodes = get_label_index().nodes
         matched_node = match_node_from_label_expr(label, nodes)
         if matched_node:
             return matched_node
@@ -208,13 +305,15 @@ def from_offline_label(string):
         u"All nodes of label \u2018{0}\u2019 are offline"
     """
     # effing unicode to have nice cute quotes in the UI
-    string = sanitize_string(string)
-    label = string.split()[-3]
+    return _match_offline_label(sanitize_string(string).split()[-3])
+
+
+def _match_offline_label(label):
     # first check if we get a match from a single label, e.g. 'amd64'
     single_label_match = match_node_from_label(label)
     # otherwise, fallback to multi-labels, like 'amd64&&trusty'
     if not single_label_match:
-        return from_offline_node_label(label)
+        return _match_offline_node_label(label)
     return single_label_match
 
 
@@ -224,16 +323,7 @@ def from_offline_node(string):
 
         "{0} is offline"
     """
-    node = string.split()[0]
-    configured_nodes = get_nodes()
-    # node can be a node as a key in the config, so try to get that first. Try
-    # first with no sanitizing of the node name, and if that doesn't work, try
-    # by splitting on possible use of __IP'
-    match = get_key(configured_nodes, node)
-    if match is None:
-        node = node.split('__')[0]
-        match = node if node in configured_nodes else None
-    return match
+    return from_offline_executor(string.split()[0])
 
 
 def from_offline_executor(node):
@@ -243,7 +333,7 @@ def from_offline_executor(node):
     """
     if node is None:
         return None
-    configured_nodes = get_nodes()
+    configured_nodes = get_label_index().nodes
     # node can be a node as a key in the config, so try to get that first. Try
     # first with no sanitizing of the node name, and if that doesn't work, try
     # by splitting on possible use of __IP'
@@ -260,21 +350,92 @@ def from_node_without_label(string):
 
         u"... {0} doesn\u2019t have label ..."
     """
-    messages = string.split(';')
-    for message in messages:
-        if u"doesn\u2019t have label" in message:
-            node = from_label(message)
-            if not node:
-                continue
-            return node
+    return _match_without_label([
+        _last_word(message) for message in string.split(';')
+        if NOT_HAVING_LABEL in message
+    ])
+
+
+def _match_without_label(labels):
+    for label in labels:
+        if not label:
+            continue
+        node = _match_node_or_label(label)
+        if not node:
+            continue
+        return node
     logger.warning('tried to match a node without label but failed')
 
 
+_reason_matchers = {
+    'busy': _match_node_or_label,
+    'offline_label': _match_offline_label,
+    'offline_node': from_offline_executor,
+    'offline_node_label': _match_offline_node_label,
+    'without_label': _match_without_label,
+}
+
+
+class LabelIndex(object):
+    """
+    Maps every label to the configured node types that have it (in the order
+    of the configuration), and every node type to the set of its labels. So
+    that matching labels to a node type doesn't need to go over all the
+    configured nodes.
+    """
+
+    def __init__(self, configured_nodes):
+        self.nodes = configured_nodes
+        self.labels = {}
+        self.by_label = {}
+        for node, metadata in configured_nodes.items():
+            labels = set(metadata.get('labels') or [])
+            self.labels[node] = labels
+            for label in labels:
+                self.by_label.setdefault(label, []).append(node)
+
+    def match_label(self, label):
+        nodes = self.by_label.get(label)
+        if nodes:
+            return nodes[0]
+
+    def match_labels(self, labels):
+        labels = set(labels)
+        # only the node types having the least common label can have them all
+        candidates = min((self.by_label.get(l, []) for l in labels), key=len)
+        for node in candidates:
+            if labels <= self.labels[node]:
+                return node
+
+
+# the index for the configured nodes, along with the configuration object it
+# was built from, to know when it needs to be built again
+_label_index = (None, None)
+
+
+def get_label_index():
+    """
+    Return the :class:`LabelIndex` of the configured nodes. It is built once
+    when the configuration is loaded, and built again whenever the ``nodes``
+    configuration is replaced (e.g. with ``set_config``).
+    """
+    global _label_index
+    source, index = _label_index
+    nodes = conf['nodes']
+    if index is None or source is not nodes:
+        index = LabelIndex(get_nodes())
+        _label_index = (nodes, index)
+    return index
+
+
+def _index_for(configured_nodes):
+    if configured_nodes:
+        return LabelIndex(configured_nodes)
+    return get_label_index()
+
+
 def match_node_from_label(label, configured_nodes=None):
-    configured_nodes = configured_nodes or get_nodes()
-    for node, metadata in configured_nodes.items():
-        if label in metadata['labels']:
-            return node
+    return _index_for(configured_nodes).match_label(label)
 
 
 def match_node_from_labels(labels, configured_nodes=None):
@@ -284,17 +445,7 @@ def match_node_from_labels(labels, configured_nodes=None):
     """
     if not labels:
         return
-    configured_nodes = configured_nodes or get_nodes()
-
-    def labels_exist(config):
-        for l in labels:
-            if l not in config:
-                return False
-        return True
-
-    for node, metadata in configured_nodes.items():
-        if labels_exist(metadata['labels']):
-            return node
+    return _index_for(configured_nodes).match_labels(labels)
 
 
 def match_node_from_label_expr(expr, configured_nodes=None):
@@ -304,7 +455,7 @@ def match_node_from_label_expr(expr, configured_nodes=None):
     """
     if not expr:
         return
-    configured_nodes = configured_nodes or get_nodes()
+    configured_nodes = configured_nodes or get_label_index().nodes
 
     matches = matching_nodes(expr, configured_nodes)
     # XXX return first?  random?  try to figure out if
@@ -329,41 +480,188 @@ def get_nodes():
         return conf['nodes']
 
 
-def get_jenkins_name(uuid):
+# only ask for what is needed from every agent, the complete computer API
+# response is very large
+JENKINS_NODES_TREE = (
+    'computer[displayName,idle,offline,numExecutors,executors[idle],assignedLabels[name]]'
+)
+
+
+def get_jenkins_nodes():
     """
-    Given a node's identifier use the jenkins api to find a node name in jenkins
-    that includes that uuid and return it.
+    Fetch the state of every Jenkins agent with a single request, instead of
+    listing them and then asking for the information of each one. Returns
+    a list of dictionaries like::
+
+        {'name': 'centos7__2f3a...', 'idle': True, 'offline': False,
+         'executors': 2, 'busy_executors': 0, 'labels': ['amd64', 'huge']}
     """
-    conn = jenkins_connection()
-    nodes = conn.get_nodes()
-    for node in nodes:
-        if uuid in node['name']:
-            return node['name']
+    url = os.path.join(conf.jenkins['url'], 'computer/api/json')
+    response = jenkins_session().get(url, params={'tree': JENKINS_NODES_TREE})
+    response.raise_for_status()
+    nodes = []
+    for computer in response.json().get('computer', []):
+        executors = computer.get('executors') or []
+        nodes.append({
+            'name': computer['displayName'],
+            'idle': computer.get('idle', False),
+            'offline': computer.get('offline', False),
+            'executors': computer.get('numExecutors', len(executors)),
+            'busy_executors': len([e for e in executors if not e.get('idle', True)]),
+            # every agent has its own name as a label too, which is not
+            # something that can be configured
+            'labels': [
+                l['name'] for l in computer.get('assignedLabels') or []
+                if l.get('name') != computer['displayName']
+            ],
+        })
+    return nodes
+
+
+# A snapshot of every Jenkins agent (see :func:`get_jenkins_nodes`) shared by
+# all the tasks and requests of the process, so that asking about many agents
+# costs a single listing: when it expires, the agents by name, and the names
+# of the agents by identifier of the mita node (registered in Jenkins as
+# ``<name>__<identifier>``)
+_jenkins_agents = (0, {}, {})
+
+
+def load_jenkins_agents(jenkins_nodes):
+    """
+    Replace the snapshot of the Jenkins agents with an (already fetched)
+    listing of agents. Returns the agents by name.
+    """
+    global _jenkins_agents
+    agents = dict((agent['name'], agent) for agent in jenkins_nodes)
+    by_identifier = index_jenkins_names(agents)
+    expires = time.time() + conf.get('jenkins', {}).get('agents_ttl', 60)
+    _jenkins_agents = (expires, agents, by_identifier)
+    return agents
+
+
+def get_jenkins_agents(refresh=False):
+    """
+    The Jenkins agents by name, from the shared snapshot. The agents are
+    listed again when ``refresh`` is ``True`` or when the snapshot is older
+    than the ``agents_ttl`` key of the ``jenkins`` configuration (60 seconds
+    by default).
+    """
+    expires, agents, by_identifier = _jenkins_agents
+    if refresh or time.time() >= expires:
+        agents = load_jenkins_agents(get_jenkins_nodes())
+    return agents
+
+
+def invalidate_jenkins_agents(name=None):
+    """
+    Remove an agent that changed (or no longer exists) from the snapshot, or
+    the whole snapshot when no name is given so that the agents are listed
+    again the next time they are needed.
+    """
+    global _jenkins_agents
+    if name is None:
+        _jenkins_agents = (0, {}, {})
+        return
+    expires, agents, by_identifier = _jenkins_agents
+    agents.pop(name, None)
+    for identifier, agent_name in by_identifier.items():
+        if agent_name == name:
+            by_identifier.pop(identifier, None)
+
+
+def get_jenkins_name(uuid, refresh_on_miss=True):
+    """
+    Given a node's identifier find the name of the Jenkins agent that includes
+    that uuid and return it, from the snapshot of the agents. Unless
+    ``refresh_on_miss`` is ``False`` the agents are listed again when a node
+    is not found, because it may have joined after the snapshot was taken.
+    """
+    refreshed = time.time() >= _jenkins_agents[0]
+    get_jenkins_agents()
+    name = _find_jenkins_name(uuid)
+    if name is None and refresh_on_miss and not refreshed:
+        get_jenkins_agents(refresh=True)
+        name = _find_jenkins_name(uuid)
+    return name
+
+
+def index_jenkins_names(names):
+    """
+    Map the identifiers of the nodes to the names of their Jenkins agents,
+    for the agents named following the ``<name>__<identifier>`` convention.
+    """
+    by_identifier = {}
+    for name in names:
+        parts = name.split('__')
+        if len(parts) > 1:
+            by_identifier[parts[-1]] = name
+    return by_identifier
+
+
+def _find_jenkins_name(uuid):
+    expires, agents, by_identifier = _jenkins_agents
+    return find_jenkins_name(uuid, agents, by_identifier)
+
+
+def find_jenkins_name(uuid, agents, by_identifier):
+    """
+    The name of the agent (in ``agents``) for the node with identifier
+    ``uuid``, using the index from ``index_jenkins_names`` first.
+    """
+    if uuid in by_identifier:
+        return by_identifier[uuid]
+    # agents that were not registered following the naming convention
+    for name in agents:
+        if uuid in name:
+            return name
     return None
 
 
+def parse_node_labels(xml_configuration, chunk_size=4096):
+    """
+    The labels from the configuration of an agent. The XML should look like::
+
+        <slave> ... <label>amd64 centos7 x86_64 huge</label> ... </slave>
+
+    Parsing stops at the ``label`` element.
+    """
+    chunks = (
+        xml_configuration[i:i + chunk_size]
+        for i in range(0, len(xml_configuration), chunk_size)
+    )
+    labels = parse_child_text(chunks, 'label')
+    return labels.split() if labels else []
+
+
 def get_node_labels(node_name, _xml_configuration=None):
     """
     Useful when a custom node was added with a name that mita does not
-    understand due to odd/unsupported naming conventions. The Jenkins Python
-    module doesn't have a nice JSON representation from the Jenkins API
-    response to look at the labels, so this parses that output looking for the
-    right tag and extracting the labels from there.
+    understand due to odd/unsupported naming conventions.
+
+    The labels come from the snapshot of the Jenkins agents. If the agents
+    can't be listed, this falls back to the configuration of the agent,
+    looking for the right tag and extracting the labels from there.
     """
-    conn = jenkins_connection()
+    if _xml_configuration:
+        return parse_node_labels(_xml_configuration)
     node_name = node_name.encode('ascii', errors='ignore')
+
+    try:
+        agents = get_jenkins_agents()
+    except Exception:
+        logger.exception('unable to get the labels of all the Jenkins agents')
+    else:
+        # when the snapshot doesn't have it, this is not a Jenkins agent
+        agent = agents.get(node_name)
+        return list(agent['labels']) if agent else []
+
+    conn = jenkins_connection()
     try:
-        xml_configuration = _xml_configuration or conn.get_node_config(node_name)
+        xml_configuration = conn.get_node_config(node_name)
     except JenkinsNotFoundException:
         logging.warning('"%s" was not found in Jenkins', node_name)
         return []
-    xml_object = ElementTree.fromstring(xml_configuration)
-    for node in xml_object:
-        if node.tag == 'label':
-            # node labels are in this tag, parse the text. The XML should look
-            # like:  <label>amd64 centos7 x86_64 huge</label>
-            return node.text.split()
-    return []
+    return parse_node_labels(xml_configuration)
 
 
 def delete_jenkins_node(name):
@@ -374,35 +672,197 @@ def delete_jenkins_node(name):
         return
     if conn.node_exists(name):
         conn.delete_node(name)
+        invalidate_jenkins_agents(name)
         return
     logger.info("Node does not exist in Jenkins, cannot delete")
 
 
-def delete_provider_node(provider, name):
+def update_idle_state(node, idle, get_connection=jenkins_connection, now=None):
+    """
+    Apply the idle (or active) state that Jenkins reports for a node. A node
+    that becomes idle gets the current timestamp in ``idle_since``, and one
+    that has been idle for more than 40 minutes gets removed from Jenkins, the
+    cloud provider and the database.
+
+    Returns the transition that happened: 'active', 'idle', 'destroyed', or
+    ``None`` if nothing changed.
+    """
+    if not idle:
+        if node.idle_since is None:
+            return None
+        logger.info("Marking %s as active." % node.identifier)
+        node.idle_since = None
+        return 'active'
+
+    now = now or datetime.utcnow()
+    if not node.idle:
+        # mark it as being idle
+        node.idle_since = now
+        return 'idle'
+
+    # it was idle before so check how many seconds since it was lazy. `idle`
+    # is a property that will only be true-ish if idle_since has been set.
+    if seconds_since(node.idle_since, now) <= IDLE_SECONDS:
+        return None
+
+    # talk to Jenkins again, make sure this node didn't get picked up on its
+    # way here
+    conn = get_connection()
+    jenkins_name = node.jenkins_name
+    if conn.node_exists(jenkins_name):
+        if conn.get_node_info(jenkins_name).get('idle'):
+            logger.info("[jenkins] removing node: %s" % jenkins_name)
+            conn.delete_node(jenkins_name)
+            invalidate_jenkins_agents(jenkins_name)
+        else:
+            logger.warning('skipping deletion of node, no longer idle: %s', jenkins_name)
+            return None
+    # we need to terminate this couch potato
+    logger.info("[cloud] destroying node: %s" % node.cloud_name)
+    try:
+        providers.get(node.provider).destroy_node(
+            name=node.cloud_name,
+            provider_id=node.provider_id,
+            volume_id=node.volume_id,
+            storage=node.storage,
+        )
+    except CloudNodeNotFound:
+        logger.info("node does not exist in cloud provider")
+    # delete from our database
+    node.delete()
+    return 'destroyed'
+
+
+def delete_provider_node(provider, name, provider_id=None, volume_id=None, storage=None):
     # we need to terminate this couch potato
     logger.info("Destroying cloud node: %s" % name)
     try:
-        provider.destroy_node(name=name)
+        provider.destroy_node(
+            name=name, provider_id=provider_id, volume_id=volume_id, storage=storage)
     except CloudNodeNotFound:
         logger.info("Node does not exist in cloud provider, cannot delete")
     except Exception:
         logger.exception("encountered errors while trying to delete node from cloud provider")
 
 
-def match_node_from_job_config(job_url):
+# how many job configurations are kept around, the least recently used ones
+# (likely jobs that were removed or renamed) go first
+JOB_LABELS_CACHE_SIZE = 1024
+
+# job URL -> the label expression (``assignedNode``) from its configuration,
+# along with the validators to ask Jenkins if it changed
+_job_labels = LRUCache(JOB_LABELS_CACHE_SIZE)
+
+
+def job_labels_are_cached(job_url):
+    return job_url in _job_labels
+
+
+class ChildTextTarget(object):
+    """
+    An ``XMLParser`` target that only keeps the text of one element (a direct
+    child of the root, like ``find(tag)``) of a Jenkins configuration, and
+    tells when it is done so that the rest of the (possibly very large)
+    document doesn't need to be parsed.
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.depth = 0
+        self.inside = False
+        self.found = False
+        self.text = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if tag == self.tag and self.depth == 2 and not self.found:
+            self.inside = True
+
+    def end(self, tag):
+        if self.inside:
+            self.inside = False
+            self.found = True
+        self.depth -= 1
+
+    def data(self, data):
+        if self.inside:
+            self.text.append(data)
+
+    def close(self):
+        return self.value
+
+    @property
+    def value(self):
+        if self.found:
+            return ''.join(self.text)
+
+
+def parse_child_text(chunks, tag):
+    """
+    Feed the chunks of a configuration to the parser, and stop as soon as the
+    ``tag`` element has been parsed. Returns its text, or ``None`` if the
+    configuration doesn't have one.
+    """
+    target = ChildTextTarget(tag)
+    parser = ElementTree.XMLParser(target=target)
+    for chunk in chunks:
+        parser.feed(chunk)
+        if target.found:
+            break
+    return target.value
+
+
+def parse_assigned_node(chunks):
+    """
+    The label expression (``assignedNode``) from the chunks of a job
+    configuration
+    """
+    return parse_child_text(chunks, 'assignedNode')
+
+
+def get_job_label_expression(job_url):
+    """
+    Get the label expression a job needs from its configuration. The result
+    is cached by job URL, and revalidated with Jenkins using the ETag and
+    Last-Modified headers so that the configuration is only downloaded (and
+    parsed) again when it changes.
+    """
     config_url = os.path.join(job_url, "config.xml")
+    cached = _job_labels.get(job_url)
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
     logger.info("Getting job config from: %s", config_url)
-    response = requests.get(config_url, auth=(conf.jenkins['user'], conf.jenkins['token']))
-    try:
-        response.raise_for_status()
-    except Exception:
-        logger.exception("failed to retrieve job config from: %s", job_url)
-        return None
-    element_tree = ElementTree.fromstring(response.text)
+    response = jenkins_session().get(config_url, headers=headers, stream=True)
     try:
-        label_expression = element_tree.find('assignedNode').text
-    except AttributeError:
-        logger.warning("Did not find 'assignedNode' in job config %s", job_url)
+        if cached and response.status_code == 304:
+            logger.info("job config has not changed for: %s", job_url)
+            return cached['label_expression']
+        try:
+            response.raise_for_status()
+        except Exception:
+            logger.exception("failed to retrieve job config from: %s", job_url)
+            _job_labels.pop(job_url, None)
+            return None
+        label_expression = parse_assigned_node(response.iter_content(chunk_size=8192))
+    finally:
+        response.close()
+
+    _job_labels.set(job_url, {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'label_expression': label_expression,
+    })
+    return label_expression
+
+
+def match_node_from_job_config(job_url):
+    label_expression = get_job_label_expression(job_url)
+    if label_expression is None:
+        logger.warning("Did not find a label expression for job %s", job_url)
         return None
     logger.info("Found label expression: %s", label_expression)
     node = match_node_from_label_expr(label_expression)